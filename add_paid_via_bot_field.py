@@ -21,21 +21,27 @@ def add_paid_via_bot_field():
     print("🔄 Начинаем миграцию: добавление поля paid_via_bot...")
     print()
 
+    # На время разовой миграции отключаем fsync и WAL
+    db.execute_sql("PRAGMA synchronous=OFF")
+    db.execute_sql("PRAGMA journal_mode=MEMORY")
+
     try:
         migrator = SqliteMigrator(db)
 
         # Добавляем поле paid_via_bot со значением по умолчанию True
         paid_via_bot_field = BooleanField(default=True)
 
-        migrate(
-            migrator.add_column('subscriptions', 'paid_via_bot', paid_via_bot_field)
-        )
+        # DDL и обновление записей — одной транзакцией
+        with db.atomic():
+            migrate(
+                migrator.add_column('subscriptions', 'paid_via_bot', paid_via_bot_field)
+            )
+
+            # Проверяем: обновляем все существующие записи
+            count = Subscription.update(paid_via_bot=True).execute()
 
         print("✅ Поле paid_via_bot успешно добавлено в таблицу subscriptions")
         print()
-
-        # Проверяем: обновляем все существующие записи
-        count = Subscription.update(paid_via_bot=True).execute()
         print(f"📊 Обновлено записей: {count}")
         print()
         print("=" * 60)
@@ -48,6 +54,11 @@ def add_paid_via_bot_field():
         traceback.print_exc()
         sys.exit(1)
 
+    finally:
+        # Возвращаем рабочие настройки БД (как в database.models)
+        db.execute_sql("PRAGMA journal_mode=WAL")
+        db.execute_sql("PRAGMA synchronous=NORMAL")
+
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Миграция: Индексы для фильтров по подпискам в таблице subscriptions
+"""
+
+import sys
+import os
+
+# Добавляем путь к src для импорта моделей
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
+
+from database.models import db
+
+# (имя индекса, SQL создания)
+INDEXES = [
+    (
+        "idx_sub_user_status_expires",
+        "CREATE INDEX IF NOT EXISTS idx_sub_user_status_expires "
+        "ON subscriptions(user_id, status, expires_at)"
+    ),
+    # Фильтры "активные"/"истекающие" и get_stats(): status IN (...) AND expires_at в диапазоне
+    (
+        "idx_sub_status_expires",
+        "CREATE INDEX IF NOT EXISTS idx_sub_status_expires "
+        "ON subscriptions(status, expires_at)"
+    ),
+]
+
+
+def add_subscription_indexes():
+    """Создать индексы в subscriptions"""
+
+    print("🔄 Начинаем миграцию: индексы таблицы subscriptions...")
+    print()
+
+    try:
+        with db.atomic():
+            for name, sql in INDEXES:
+                db.execute_sql(sql)
+                print(f"✅ Индекс {name} создан")
+
+        # Проверка: фильтр "истекающие" должен идти по индексу, а не SCAN
+        plan = db.execute_sql(
+            "EXPLAIN QUERY PLAN SELECT user_id FROM subscriptions "
+            "WHERE status IN ('active', 'expiring_soon') "
+            "AND expires_at > datetime('now') AND expires_at <= datetime('now', '+3 days')"
+        ).fetchall()
+        print()
+        for row in plan:
+            print(f"📊 {row[-1]}")
+
+        print()
+        print("=" * 60)
+        print("✅ Миграция завершена успешно!")
+        print("=" * 60)
+
+    except Exception as e:
+        print(f"❌ Ошибка миграции: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    try:
+        add_subscription_indexes()
+    except KeyboardInterrupt:
+        print("\n\n⚠️  Миграция прервана пользователем")
+    except Exception as e:
+        print(f"\n\n❌ Критическая ошибка: {e}")
+        import traceback
+        traceback.print_exc()
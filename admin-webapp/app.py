@@ -7,45 +7,52 @@ FastAPI backend + статика для Telegram WebApp
 """
 
 import os
+import re
 import sys
+import time
+import asyncio
 import hmac
 import hashlib
 import json
 import logging
-from datetime import datetime, date, timedelta
-from typing import Optional, List
-from urllib.parse import parse_qsl
+from datetime import datetime, date, timedelta, time as dt_time
+from typing import Optional, List, Dict, Tuple
+from urllib.parse import unquote_plus
 
 from fastapi import FastAPI, HTTPException, Request, Depends
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse
 from pydantic import BaseModel
+from peewee import fn, SQL
 
 # Добавляем путь к src для импорта моделей
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
-from config import BOT_TOKEN, ADMIN_ID
+# DEV_MODE отключён по умолчанию для безопасности
+# Для локальной разработки установите: export DEV_MODE=1
+# При запуске скриптом (python app.py) включаем его до импорта config, который читает env один раз
+if __name__ == "__main__":
+    os.environ["DEV_MODE"] = "1"  # TODO: убрать для production
+
+from config import BOT_TOKEN, ADMIN_ID, DEV_MODE
 from database.models import (
     User, Subscription, Forecast, SupportTicket, SupportMessage,
     get_stats, init_db, db
 )
-from services.geocoder import quick_geocode, format_coordinates, search_cities, get_timezone_offset
+from services.geocoder import (
+    quick_geocode, format_coordinates, search_cities, get_timezone_offset,
+    get_zoneinfo, tf
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Astro Admin", version="1.0.0")
+# orjson сериализует ответы заметно быстрее стандартного json
+app = FastAPI(title="Astro Admin", version="1.0.0", default_response_class=ORJSONResponse)
 
-# CORS для Telegram WebApp
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# CORS не подключаем: фронтенд (templates/index.html) ходит в /api с того же origin,
+# а WebView Telegram CORS не применяет — middleware только тратила время на каждом запросе
 
 # Статика и шаблоны
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -99,55 +106,112 @@ class TimezoneRequest(BaseModel):
     lon: float
 
 
+# ============== ПАРСИНГ И ФОРМАТИРОВАНИЕ ДАТ ==============
+
+_DATE_RE = re.compile(r'^(\d{1,2})\.(\d{1,2})\.(\d{4})$')
+_TIME_RE = re.compile(r'^(\d{1,2}):(\d{1,2})(?::(\d{1,2}))?$')
+
+
+def parse_birth_date(value: str) -> date:
+    """Дата рождения из DD.MM.YYYY (ValueError при неверном формате)"""
+    m = _DATE_RE.match(value.strip())
+    if not m:
+        raise ValueError(f"дата '{value}' не в формате DD.MM.YYYY")
+    return date(int(m[3]), int(m[2]), int(m[1]))
+
+
+def parse_birth_time(value: str) -> dt_time:
+    """Время рождения из HH:MM:SS или HH:MM (ValueError при неверном формате)"""
+    m = _TIME_RE.match(value.strip())
+    if not m:
+        raise ValueError(f"время '{value}' не в формате HH:MM:SS")
+    return dt_time(int(m[1]), int(m[2]), int(m[3] or 0))
+
+
+# Форматы фиксированные — f-строки вместо strftime (без разбора формата и локали)
+
+def _fmt_date(d) -> Optional[str]:
+    """DD.MM.YYYY"""
+    return None if d is None else f"{d.day:02d}.{d.month:02d}.{d.year:04d}"
+
+
+def _fmt_time(t) -> Optional[str]:
+    """HH:MM:SS"""
+    return None if t is None else f"{t.hour:02d}:{t.minute:02d}:{t.second:02d}"
+
+
+def _fmt_dt(dt) -> Optional[str]:
+    """DD.MM.YYYY HH:MM"""
+    if dt is None:
+        return None
+    return f"{dt.day:02d}.{dt.month:02d}.{dt.year:04d} {dt.hour:02d}:{dt.minute:02d}"
+
+
 # ============== TELEGRAM AUTH ==============
 
+# Секретный ключ зависит только от BOT_TOKEN — считаем один раз при импорте
+_TG_SECRET_KEY = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+_TG_BASE_HMAC = hmac.new(_TG_SECRET_KEY, digestmod=hashlib.sha256)
+
+
 def validate_telegram_auth(init_data: str) -> Optional[dict]:
     """
     Проверка подписи initData от Telegram WebApp
     https://core.telegram.org/bots/webapps#validating-data-received-via-the-mini-app
     """
     try:
-        parsed = dict(parse_qsl(init_data, keep_blank_values=True))
-
-        if 'hash' not in parsed:
+        # Один проход: разбор пар, сортировка по ключу (как в спецификации Telegram),
+        # отделение hash и сборка data_check_string
+        pairs = []
+        for part in init_data.split('&'):
+            if not part:
+                continue
+            k, _, v = part.partition('=')
+            pairs.append((unquote_plus(k), unquote_plus(v)))
+        pairs.sort(key=lambda kv: kv[0])
+
+        received_hash = None
+        user_json = None
+        dcs_parts = []
+        for k, v in pairs:
+            if k == 'hash':
+                received_hash = v
+                continue
+            if k == 'user':
+                user_json = v
+            dcs_parts.append(f"{k}={v}")
+
+        if received_hash is None:
             return None
 
-        received_hash = parsed.pop('hash')
-
-        # Создаём data_check_string
-        data_check_arr = sorted([f"{k}={v}" for k, v in parsed.items()])
-        data_check_string = '\n'.join(data_check_arr)
+        data_check_string = '\n'.join(dcs_parts)
 
-        # Секретный ключ
-        secret_key = hmac.new(
-            b"WebAppData",
-            BOT_TOKEN.encode(),
-            hashlib.sha256
-        ).digest()
+        # Вычисляем hash (копия заранее инициализированного HMAC)
+        h = _TG_BASE_HMAC.copy()
+        h.update(data_check_string.encode())
+        calculated_hash = h.hexdigest()
 
-        # Вычисляем hash
-        calculated_hash = hmac.new(
-            secret_key,
-            data_check_string.encode(),
-            hashlib.sha256
-        ).hexdigest()
-
-        if calculated_hash != received_hash:
+        if not hmac.compare_digest(calculated_hash, received_hash):
             logger.warning("Invalid hash in initData")
             return None
 
         # Парсим user
-        if 'user' in parsed:
-            user_data = json.loads(parsed['user'])
-            return user_data
+        if user_json is not None:
+            return json.loads(user_json)
 
-        return parsed
+        return {k: v for k, v in pairs if k != 'hash'}
 
     except Exception as e:
         logger.error(f"Error validating Telegram auth: {e}")
         return None
 
 
+# Кэш успешных проверок initData: {init_data: (expires_monotonic, user_data)}
+_AUTH_CACHE_TTL = 60  # секунд
+_AUTH_CACHE_MAX = 1024
+_auth_cache: Dict[str, Tuple[float, dict]] = {}
+
+
 async def get_current_admin(request: Request) -> dict:
     """
     Dependency для проверки авторизации админа
@@ -157,13 +221,25 @@ async def get_current_admin(request: Request) -> dict:
                 request.query_params.get("initData")
 
     # Для разработки — можно отключить проверку
-    if os.getenv("DEV_MODE") == "1":
+    if DEV_MODE:
         return {"id": ADMIN_ID, "first_name": "Dev Admin"}
 
     if not init_data:
         raise HTTPException(status_code=401, detail="No auth data")
 
-    user_data = validate_telegram_auth(init_data)
+    # Один и тот же initData приходит со всеми запросами сессии — берём из кэша
+    now = time.monotonic()
+    cached = _auth_cache.get(init_data)
+    if cached and cached[0] > now:
+        user_data = cached[1]
+    else:
+        # HMAC + JSON — в отдельном потоке, чтобы не блокировать event loop
+        user_data = await asyncio.to_thread(validate_telegram_auth, init_data)
+        if user_data:
+            if len(_auth_cache) >= _AUTH_CACHE_MAX:
+                _auth_cache.clear()
+            _auth_cache[init_data] = (now + _AUTH_CACHE_TTL, user_data)
+
     if not user_data:
         raise HTTPException(status_code=401, detail="Invalid auth")
 
@@ -192,6 +268,26 @@ async def api_stats(admin: dict = Depends(get_current_admin)):
     return stats
 
 
+def _user_list_item(user: dict, sub: Optional[Subscription], now: datetime) -> dict:
+    """Строка списка пользователей (user — dict из .dicts())"""
+    return {
+        "telegram_id": user["telegram_id"],
+        "username": user["username"],
+        "first_name": user["first_name"],
+        "birth_date": _fmt_date(user["birth_date"]),
+        "birth_time": _fmt_time(user["birth_time"]),
+        "birth_place": user["birth_place"],
+        "residence_place": user["residence_place"],
+        "natal_data_complete": user["natal_data_complete"],
+        "subscription": {
+            "status": sub.status,
+            "expires_at": _fmt_date(sub.expires_at),
+            "days_left": sub.days_left_at(now)
+        } if sub else None,
+        "created_at": _fmt_dt(user["created_at"])
+    }
+
+
 @app.get("/api/users")
 async def api_users(
     filter: str = "all",
@@ -204,60 +300,60 @@ async def api_users(
     now = datetime.now()
     three_days = now + timedelta(days=3)
 
-    query = User.select()
+    # Только колонки, нужные для списка
+    query = User.select(
+        User.telegram_id, User.username, User.first_name,
+        User.birth_date, User.birth_time, User.birth_place,
+        User.residence_place, User.natal_data_complete, User.created_at
+    )
 
-    # Фильтры
+    # Фильтры по подписке — JOIN по индексу subscriptions(user_id, status, expires_at).
+    # У пользователя может быть несколько подписок, поэтому GROUP BY
+    # (а не DISTINCT — оконный COUNT ниже считается после группировки).
     if filter == "active":
-        active_ids = Subscription.select(Subscription.user).where(
+        query = query.join(Subscription).where(
             Subscription.status.in_(['active', 'expiring_soon']),
             Subscription.expires_at > now
-        )
-        query = query.where(User.telegram_id.in_(active_ids))
+        ).group_by(User.telegram_id)
     elif filter == "expired":
-        expired_ids = Subscription.select(Subscription.user).where(
+        query = query.join(Subscription).where(
             Subscription.status == 'expired'
-        )
-        query = query.where(User.telegram_id.in_(expired_ids))
+        ).group_by(User.telegram_id)
     elif filter == "expiring":
-        expiring_ids = Subscription.select(Subscription.user).where(
+        query = query.join(Subscription).where(
             Subscription.status.in_(['active', 'expiring_soon']),
             Subscription.expires_at <= three_days,
             Subscription.expires_at > now
-        )
-        query = query.where(User.telegram_id.in_(expiring_ids))
+        ).group_by(User.telegram_id)
     elif filter == "nodata":
         query = query.where(User.natal_data_complete == False)
 
-    # Поиск
+    # Поиск: число — по telegram_id, текст — по началу имени/username
+    # (LIKE 'x%' использует индексы idx_user_first_name/idx_user_username)
     if search:
-        query = query.where(
-            (User.first_name.contains(search)) |
-            (User.username.contains(search)) |
-            (User.telegram_id == int(search) if search.isdigit() else False)
-        )
-
-    total = query.count()
-    users = list(query.order_by(User.created_at.desc()).offset(page * limit).limit(limit))
-
-    result = []
-    for user in users:
-        sub = user.get_subscription()
-        result.append({
-            "telegram_id": user.telegram_id,
-            "username": user.username,
-            "first_name": user.first_name,
-            "birth_date": user.birth_date.strftime("%d.%m.%Y") if user.birth_date else None,
-            "birth_time": user.birth_time.strftime("%H:%M:%S") if user.birth_time else None,
-            "birth_place": user.birth_place,
-            "residence_place": user.residence_place,
-            "natal_data_complete": user.natal_data_complete,
-            "subscription": {
-                "status": sub.status if sub else "none",
-                "expires_at": sub.expires_at.strftime("%d.%m.%Y") if sub and sub.expires_at else None,
-                "days_left": sub.days_left if sub else 0
-            } if sub else None,
-            "created_at": user.created_at.strftime("%d.%m.%Y %H:%M") if user.created_at else None
-        })
+        if search.isdigit():
+            query = query.where(User.telegram_id == int(search))
+        else:
+            query = query.where(
+                User.first_name.startswith(search) |
+                User.username.startswith(search)
+            )
+
+    # Общее количество берём из той же выборки через COUNT(*) OVER ()
+    users = list(
+        query.select_extend(fn.COUNT(SQL('*')).over().alias('total'))
+        .order_by(User.created_at.desc())
+        .offset(page * limit)
+        .limit(limit)
+        .dicts()
+    )
+    # Пустая страница (вышли за конец списка) — отдельный COUNT
+    total = users[0]["total"] if users else query.count()
+
+    # Подписки всей страницы одним запросом
+    subs = Subscription.get_current_for_users([u["telegram_id"] for u in users])
+
+    result = [_user_list_item(user, subs.get(user["telegram_id"]), now) for user in users]
 
     return {
         "users": result,
@@ -270,13 +366,12 @@ async def api_users(
 @app.get("/api/users/{telegram_id}")
 async def api_user_detail(telegram_id: int, admin: dict = Depends(get_current_admin)):
     """Детали пользователя"""
-    try:
-        user = User.get_by_id(telegram_id)
-    except User.DoesNotExist:
+    # Пользователь, подписка и число прогнозов — одним запросом
+    user = User.get_with_details(telegram_id)
+    if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    sub = user.get_subscription()
-    forecasts_count = Forecast.select().where(Forecast.user == user).count()
+    sub = user.current_subscription
 
     # Вычисляем поправку по времени на дату рождения
     birth_tz_offset = None
@@ -287,8 +382,8 @@ async def api_user_detail(telegram_id: int, admin: dict = Depends(get_current_ad
         "telegram_id": user.telegram_id,
         "username": user.username,
         "first_name": user.first_name,
-        "birth_date": user.birth_date.strftime("%d.%m.%Y") if user.birth_date else None,
-        "birth_time": user.birth_time.strftime("%H:%M:%S") if user.birth_time else None,
+        "birth_date": _fmt_date(user.birth_date),
+        "birth_time": _fmt_time(user.birth_time),
         "birth_place": user.birth_place,
         "birth_lat": user.birth_lat,
         "birth_lon": user.birth_lon,
@@ -303,11 +398,11 @@ async def api_user_detail(telegram_id: int, admin: dict = Depends(get_current_ad
         "natal_data_complete": user.natal_data_complete,
         "subscription": {
             "status": sub.status if sub else "none",
-            "expires_at": sub.expires_at.strftime("%d.%m.%Y %H:%M") if sub and sub.expires_at else None,
+            "expires_at": _fmt_dt(sub.expires_at) if sub else None,
             "days_left": sub.days_left if sub else 0
         } if sub else None,
-        "forecasts_count": forecasts_count,
-        "created_at": user.created_at.strftime("%d.%m.%Y %H:%M") if user.created_at else None
+        "forecasts_count": user.forecasts_count,
+        "created_at": _fmt_dt(user.created_at)
     }
 
 
@@ -315,7 +410,20 @@ async def api_user_detail(telegram_id: int, admin: dict = Depends(get_current_ad
 async def api_create_user(data: UserCreate, admin: dict = Depends(get_current_admin)):
     """Создать пользователя"""
     # Геокодинг мест - используем данные из запроса, если есть
-    if data.birth_lat and data.birth_lon and data.birth_tz:
+    need_birth_geo = not (data.birth_lat and data.birth_lon and data.birth_tz)
+    need_residence_geo = not (data.residence_lat and data.residence_lon and data.residence_tz)
+
+    # Запросы к геокодеру блокирующие — в потоках и параллельно
+    geo_tasks = []
+    if need_birth_geo:
+        geo_tasks.append(asyncio.to_thread(quick_geocode, data.birth_place))
+    if need_residence_geo:
+        geo_tasks.append(asyncio.to_thread(quick_geocode, data.residence_place))
+    geo_results = list(await asyncio.gather(*geo_tasks))
+    birth_geo = geo_results.pop(0) if need_birth_geo else None
+    residence_geo = geo_results.pop(0) if need_residence_geo else None
+
+    if not need_birth_geo:
         # Используем geo-данные из фронтенда
         birth_lat = data.birth_lat
         birth_lon = data.birth_lon
@@ -323,7 +431,6 @@ async def api_create_user(data: UserCreate, admin: dict = Depends(get_current_ad
         birth_place = data.birth_place
     else:
         # Геокодинг через API
-        birth_geo = quick_geocode(data.birth_place)
         if not birth_geo:
             raise HTTPException(status_code=400, detail=f"Город '{data.birth_place}' не найден")
         birth_lat = birth_geo.latitude
@@ -331,7 +438,7 @@ async def api_create_user(data: UserCreate, admin: dict = Depends(get_current_ad
         birth_tz = birth_geo.timezone
         birth_place = birth_geo.city
 
-    if data.residence_lat and data.residence_lon and data.residence_tz:
+    if not need_residence_geo:
         # Используем geo-данные из фронтенда
         residence_lat = data.residence_lat
         residence_lon = data.residence_lon
@@ -339,7 +446,6 @@ async def api_create_user(data: UserCreate, admin: dict = Depends(get_current_ad
         residence_place = data.residence_place
     else:
         # Геокодинг через API
-        residence_geo = quick_geocode(data.residence_place)
         if not residence_geo:
             raise HTTPException(status_code=400, detail=f"Город '{data.residence_place}' не найден")
         residence_lat = residence_geo.latitude
@@ -349,37 +455,33 @@ async def api_create_user(data: UserCreate, admin: dict = Depends(get_current_ad
 
     # Парсим дату и время
     try:
-        birth_date = datetime.strptime(data.birth_date, "%d.%m.%Y").date()
-        time_parts = data.birth_time.split(":")
-        from datetime import time
-        if len(time_parts) == 3:
-            birth_time = time(int(time_parts[0]), int(time_parts[1]), int(time_parts[2]))
-        else:
-            birth_time = time(int(time_parts[0]), int(time_parts[1]), 0)
+        birth_date = parse_birth_date(data.birth_date)
+        birth_time = parse_birth_time(data.birth_time)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=f"Неверный формат даты/времени: {e}")
 
-    # Создаём или обновляем пользователя
-    user, created = User.get_or_create(
-        telegram_id=data.telegram_id,
-        defaults={"first_name": data.first_name}
-    )
-
-    user.first_name = data.first_name
-    user.birth_date = birth_date
-    user.birth_time = birth_time
-    user.birth_place = birth_place
-    user.birth_lat = birth_lat
-    user.birth_lon = birth_lon
-    user.birth_tz = birth_tz
-    user.residence_place = residence_place
-    user.residence_lat = residence_lat
-    user.residence_lon = residence_lon
-    user.residence_tz = residence_tz
-    user.natal_data_complete = True
-    user.save()
+    # Создаём или обновляем пользователя одним INSERT ... ON CONFLICT DO UPDATE
+    row = {
+        User.first_name: data.first_name,
+        User.birth_date: birth_date,
+        User.birth_time: birth_time,
+        User.birth_place: birth_place,
+        User.birth_lat: birth_lat,
+        User.birth_lon: birth_lon,
+        User.birth_tz: birth_tz,
+        User.residence_place: residence_place,
+        User.residence_lat: residence_lat,
+        User.residence_lon: residence_lon,
+        User.residence_tz: residence_tz,
+        User.natal_data_complete: True,
+        User.updated_at: datetime.now(),
+    }
+    User.insert({User.telegram_id: data.telegram_id, **row}).on_conflict(
+        conflict_target=[User.telegram_id],
+        update=row
+    ).execute()
 
-    return {"success": True, "telegram_id": user.telegram_id, "created": created}
+    return {"success": True, "telegram_id": data.telegram_id}
 
 
 @app.patch("/api/users/{telegram_id}")
@@ -399,18 +501,13 @@ async def api_update_user(
 
     if data.birth_date:
         try:
-            user.birth_date = datetime.strptime(data.birth_date, "%d.%m.%Y").date()
+            user.birth_date = parse_birth_date(data.birth_date)
         except ValueError:
             raise HTTPException(status_code=400, detail="Неверный формат даты")
 
     if data.birth_time:
         try:
-            from datetime import time
-            parts = data.birth_time.split(":")
-            if len(parts) == 3:
-                user.birth_time = time(int(parts[0]), int(parts[1]), int(parts[2]))
-            else:
-                user.birth_time = time(int(parts[0]), int(parts[1]), 0)
+            user.birth_time = parse_birth_time(data.birth_time)
         except ValueError:
             raise HTTPException(status_code=400, detail="Неверный формат времени")
 
@@ -474,7 +571,7 @@ async def api_user_subscription(
         if not sub:
             sub = Subscription.create_for_user(user)
         sub.activate(data.days or 30)
-        return {"success": True, "expires_at": sub.expires_at.strftime("%d.%m.%Y")}
+        return {"success": True, "expires_at": _fmt_date(sub.expires_at)}
 
     elif data.action == "cancel":
         if sub:
@@ -492,10 +589,11 @@ async def api_delete_user(telegram_id: int, admin: dict = Depends(get_current_ad
     except User.DoesNotExist:
         raise HTTPException(status_code=404, detail="User not found")
 
-    # Удаляем связанные записи
-    Subscription.delete().where(Subscription.user == user).execute()
-    Forecast.delete().where(Forecast.user == user).execute()
-    user.delete_instance()
+    # Удаляем связанные записи — одной транзакцией
+    with db.atomic():
+        Subscription.delete().where(Subscription.user == user).execute()
+        Forecast.delete().where(Forecast.user == user).execute()
+        user.delete_instance()
 
     return {"success": True}
 
@@ -541,9 +639,7 @@ async def api_geocode_search(data: GeoRequest):
 @app.post("/api/timezone")
 async def api_timezone(data: TimezoneRequest):
     """Определение часового пояса по координатам (не требует авторизации для Mini App)"""
-    from timezonefinder import TimezoneFinder
-
-    tf = TimezoneFinder()
+    # Общий экземпляр TimezoneFinder из геокодера — данные полигонов грузятся один раз
     timezone = tf.timezone_at(lat=data.lat, lng=data.lon)
 
     if not timezone:
@@ -551,12 +647,7 @@ async def api_timezone(data: TimezoneRequest):
 
     # Получаем смещение в часах
     try:
-        import pytz
-        from datetime import datetime
-
-        tz = pytz.timezone(timezone)
-        now = datetime.now(tz)
-        offset_seconds = now.utcoffset().total_seconds()
+        offset_seconds = datetime.now(get_zoneinfo(timezone)).utcoffset().total_seconds()
         offset_hours = offset_seconds / 3600
     except Exception:
         offset_hours = 0
@@ -579,8 +670,4 @@ async def startup():
 if __name__ == "__main__":
     import uvicorn
 
-    # DEV_MODE отключён по умолчанию для безопасности
-    # Для локальной разработки установите: export DEV_MODE=1
-    os.environ["DEV_MODE"] = "1"  # TODO: убрать для production
-
     uvicorn.run(app, host="0.0.0.0", port=8080)
@@ -12,7 +12,7 @@ import os
 # Добавляем путь к src для импорта моделей
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
 
-from database.models import Subscription, db
+from database.models import User, Subscription, db
 
 def migrate_subscriptions():
     """Обновить существующие подписки"""
@@ -41,29 +41,32 @@ def migrate_subscriptions():
         print("❌ Миграция отменена")
         return
 
-    # Обновляем
-    updated = 0
-    errors = 0
-
-    for sub in query:
-        try:
-            sub.payment_id = "migrated"
-            sub.save()
-            updated += 1
+    # Для вывода — только нужные колонки, без загрузки моделей
+    rows = list(
+        query.select(User.telegram_id, User.username, Subscription.expires_at)
+        .join(User)
+        .tuples()
+    )
 
-            user = sub.user
-            print(f"✅ User {user.telegram_id} (@{user.username or 'без username'}) - подписка до {sub.expires_at.strftime('%d.%m.%Y')}")
+    # Обновляем одним UPDATE в одной транзакции
+    try:
+        with db.atomic():
+            updated = Subscription.update(payment_id="migrated").where(
+                (Subscription.status == "active") &
+                (Subscription.payment_id.is_null())
+            ).execute()
+    except Exception as e:
+        print(f"❌ Ошибка обновления подписок: {e}")
+        return
 
-        except Exception as e:
-            errors += 1
-            print(f"❌ Ошибка обновления подписки ID {sub.id}: {e}")
+    for telegram_id, username, expires_at in rows:
+        expires_str = expires_at.strftime('%d.%m.%Y') if expires_at else '—'
+        print(f"✅ User {telegram_id} (@{username or 'без username'}) - подписка до {expires_str}")
 
     print()
     print("=" * 60)
     print(f"✅ Миграция завершена!")
     print(f"   Обновлено: {updated}")
-    if errors > 0:
-        print(f"   Ошибок: {errors}")
     print("=" * 60)
 
 
@@ -4,17 +4,24 @@
 FastAPI приложение для Mini App астро-бота
 """
 
+import asyncio
 import logging
 import re
+import time
 import hashlib
 import hmac
+import operator
 import urllib.parse
-from datetime import date, timedelta
-from typing import Optional, List, Tuple
+import orjson
+from collections import defaultdict
+from functools import lru_cache, reduce
+from datetime import datetime, date, timedelta, time as dt_time
+from typing import Optional, List, Dict, Tuple
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Header, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from starlette.datastructures import QueryParams
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
@@ -23,7 +30,16 @@ from pathlib import Path
 # Импорт расшифровки формул
 import sys
 sys.path.insert(0, str(Path(__file__).parent.parent))
+from config import BOT_TOKEN, ADMIN_ID
 from data.formula_meanings import analyze_transit_formula
+from database.models import db, User, Subscription, CalendarCache, MoonPhase, Forecast, get_stats
+from services.astro_engine import (
+    calculate_local_natal, calculate_transits, format_transits_text,
+    get_full_moon_info, get_retrogrades_info, get_natal_chart, calculate_houses,
+    datetime_to_julian, calculate_natal_aspects, get_planet_house
+)
+from services.groq_client import generate_forecast, ask_forecast
+from services.geocoder import get_timezone_offset, search_cities, format_coordinates
 
 logger = logging.getLogger(__name__)
 
@@ -49,28 +65,87 @@ API_ERROR_MESSAGES = {
 }
 
 
+# rate limit / connection / network и прочее дают то же "сервис недоступен",
+# что и неизвестная ошибка, — отдельное сообщение только для таймаутов
+_TIMEOUT_ERR_RE = re.compile(r'timeout|timed out')
+
+
 def get_api_error(error: Exception) -> str:
     """
     Преобразует техническую ошибку в понятное пользователю сообщение для API
     """
-    error_str = str(error).lower()
-
-    if "timeout" in error_str or "timed out" in error_str:
+    if _TIMEOUT_ERR_RE.search(str(error).lower()):
         return API_ERROR_MESSAGES["timeout_error"]
-    if "rate limit" in error_str or "too many requests" in error_str:
-        return API_ERROR_MESSAGES["server_error"]
-    if "connection" in error_str or "network" in error_str:
-        return API_ERROR_MESSAGES["server_error"]
 
     return API_ERROR_MESSAGES["server_error"]
 
 
+# Окно дня для транзитов в прогнозах (ночные транзиты не показываем)
+_DAY_START = dt_time(6, 0)
+_DAY_END = dt_time(23, 55)
+
+
+def filter_day_transits(transits: List[dict]) -> List[dict]:
+    """Транзиты с точным временем в дневном окне; если таких нет — исходный список"""
+    kept = [
+        tr for tr in transits
+        if (exact_dt := tr.get('exact_datetime')) and _DAY_START <= exact_dt.time() <= _DAY_END
+    ]
+    return kept or transits
+
+
+# Форматы дат фиксированные — f-строки вместо strftime (без разбора формата и локали)
+
+@lru_cache(maxsize=4096)
+def _fmt_date_ordinal(ordinal: int) -> str:
+    """DD.MM.YYYY по date.toordinal() — одни и те же даты (сроки подписок, дни календаря) повторяются"""
+    d = date.fromordinal(ordinal)
+    return f"{d.day:02d}.{d.month:02d}.{d.year:04d}"
+
+
+def _fmt_date(d) -> Optional[str]:
+    """DD.MM.YYYY"""
+    return None if d is None else _fmt_date_ordinal(d.toordinal())
+
+
+def _fmt_dt(dt) -> Optional[str]:
+    """DD.MM.YYYY HH:MM"""
+    if dt is None:
+        return None
+    return f"{dt.day:02d}.{dt.month:02d}.{dt.year:04d} {dt.hour:02d}:{dt.minute:02d}"
+
+
+def _fmt_time(t) -> Optional[str]:
+    """HH:MM:SS (без микросекунд)"""
+    if not t:
+        return None
+    if isinstance(t, str):
+        return t[:8]
+    return f"{t.hour:02d}:{t.minute:02d}:{t.second:02d}"
+
+
+# Названия дней недели по date.weekday()
+_DAY_NAMES = ("Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье")
+
+
 # ============== ЗЛЫЕ/ДОБРЫЕ ПЛАНЕТЫ ==============
 
 # Злые (напряжённые) планеты — соединение с ними даёт негативный аспект
-MALEFIC_PLANETS = {'Марс', 'Сатурн', 'Уран', 'Нептун', 'Плутон'}
+MALEFIC_PLANETS = frozenset({'Марс', 'Сатурн', 'Уран', 'Нептун', 'Плутон'})
 # Добрые (благоприятные) планеты — соединение с ними даёт позитивный аспект
-BENEFIC_PLANETS = {'Солнце', 'Луна', 'Венера', 'Юпитер'}
+BENEFIC_PLANETS = frozenset({'Солнце', 'Луна', 'Венера', 'Юпитер'})
+
+# Природа аспектов, не зависящих от планет: aspect_name.lower() -> (nature, is_positive)
+_ASPECT_NATURE = {
+    'трин': ("positive", True),
+    'секстиль': ("positive", True),
+    'тригон': ("positive", True),
+    'квадратура': ("negative", False),
+    'оппозиция': ("negative", False),
+}
+_CONJUNCTIONS = frozenset({'соединение', 'conjunction'})
+# Индекс счётчика в [positive, negative, neutral] по nature (остальное — neutral)
+_NATURE_INDEX = {"positive": 0, "negative": 1}
 
 
 def is_conjunction_negative(transit_planet: str, natal_planet: str) -> bool:
@@ -81,28 +156,29 @@ def is_conjunction_negative(transit_planet: str, natal_planet: str) -> bool:
     return transit_planet in MALEFIC_PLANETS or natal_planet in MALEFIC_PLANETS
 
 
-def determine_aspect_nature(aspect_name: str, transit_planet: str = '', natal_planet: str = '') -> tuple:
+@lru_cache(maxsize=1024)
+def determine_aspect_nature(aspect_name: str, transit_planet: str = '', natal_planet: str = '') -> Tuple[str, bool]:
     """
     Определяет природу аспекта: nature (positive/negative/neutral) и is_positive (bool).
+    Аспектов и планет немного — результат кэшируется.
 
     Returns:
         (nature: str, is_positive: bool)
     """
     aspect = aspect_name.lower()
 
-    if aspect in ['трин', 'секстиль', 'тригон']:
-        return "positive", True
-    elif aspect in ['квадратура', 'оппозиция']:
-        return "negative", False
-    elif aspect in ['соединение', 'conjunction']:
+    result = _ASPECT_NATURE.get(aspect)
+    if result is not None:
+        return result
+
+    if aspect in _CONJUNCTIONS:
         # Соединение: проверяем злые планеты
-        if is_conjunction_negative(transit_planet, natal_planet):
+        if transit_planet in MALEFIC_PLANETS or natal_planet in MALEFIC_PLANETS:
             return "negative", False
-        else:
-            return "positive", True
-    else:
-        # Неизвестный аспект — нейтральный
-        return "neutral", True
+        return "positive", True
+
+    # Неизвестный аспект — нейтральный
+    return "neutral", True
 
 
 # Путь к статике Mini App
@@ -112,7 +188,8 @@ WEBAPP_DIR = Path(__file__).parent.parent / "webapp"
 app = FastAPI(
     title="Astro Bot API",
     description="API для Mini App астрологического бота",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS для Telegram WebApp - только доверенные домены
@@ -131,6 +208,20 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def warm_up():
+    """
+    Прогрев при запуске: первые обращения к таблицам формул, tz-базе и кэшам
+    делаем здесь, а не на первом запросе пользователя.
+    """
+    try:
+        analyze_transit_formula([1, 2], [3, 4], True)
+        get_demo_forecast(date.today())  # заполняет кэш parse_formula/get_meanings_from_formula
+        get_timezone_offset("Europe/Moscow", date.today())
+    except Exception as e:
+        logger.warning(f"API warm-up failed: {e}")
+
+
 # ============== МОДЕЛИ ==============
 
 class TransitItem(BaseModel):
@@ -189,7 +280,6 @@ async def get_moon_info():
     Не требует авторизации.
     """
     try:
-        from services.astro_engine import get_full_moon_info
         moon_data = get_full_moon_info()
         return moon_data
     except Exception as e:
@@ -204,9 +294,7 @@ async def get_retrogrades(year: int = None):
     Не требует авторизации.
     """
     try:
-        from services.astro_engine import get_retrogrades_info
         if year is None:
-            from datetime import datetime
             year = datetime.now().year
         retro_data = get_retrogrades_info(year)
         return retro_data
@@ -222,9 +310,6 @@ async def get_natal_chart_api(user_id: int):
     Формат совместим с AstrologyChart2.
     """
     try:
-        from database.models import User
-        from services.astro_engine import get_natal_chart, calculate_houses, datetime_to_julian
-        from datetime import datetime, date
 
         user = User.get_or_none(User.telegram_id == user_id)
         if not user or not user.birth_date:
@@ -232,13 +317,12 @@ async def get_natal_chart_api(user_id: int):
 
         # Получаем дату рождения (уже date объект из БД)
         birth_date = user.birth_date
-        birth_time = str(user.birth_time)[:8] if user.birth_time else "12:00:00"
+        birth_time = _fmt_time(user.birth_time) or "12:00:00"
         # Используем координаты места РОЖДЕНИЯ (не проживания!)
         lat = user.birth_lat or 55.7558
         lon = user.birth_lon or 37.6173
 
         # Timezone места рождения
-        from services.geocoder import get_timezone_offset
         birth_tz_hours = get_timezone_offset(user.birth_tz or "Europe/Moscow", birth_date)
 
         # Получаем позиции планет (get_natal_chart возвращает Dict[int, PlanetPosition])
@@ -287,10 +371,8 @@ async def get_natal_chart_api(user_id: int):
         cusps = [{"angle": round(houses.cusps[i], 2)} for i in range(12)]
 
         # Рассчитываем аспекты между планетами
-        from services.astro_engine import calculate_natal_aspects
 
         # Формируем planets_data для расчёта аспектов
-        from services.astro_engine import get_planet_house
         planets_data = {}
         for planet_id, pos in natal_positions.items():
             house_num = get_planet_house(pos.longitude, houses.cusps)
@@ -339,7 +421,12 @@ async def get_natal_chart_api(user_id: int):
 
 # ============== ПОЛЬЗОВАТЕЛЬСКИЕ ЭНДПОИНТЫ ==============
 
-from fastapi import Header as FastAPIHeader
+# Секретный ключ initData зависит только от BOT_TOKEN — считаем один раз при импорте
+_TG_SECRET_KEY = hmac.new(b'WebAppData', BOT_TOKEN.encode(), hashlib.sha256).digest()
+# HMAC с уже обработанным ключом (ipad/opad) — на запрос делаем только copy() + update().
+# Алгоритм задан Telegram (HMAC-SHA256), заменить на blake2 нельзя; hashlib берёт SHA-256
+# из OpenSSL, который сам использует SHA-NI на поддерживающих CPU.
+_TG_BASE_HMAC = hmac.new(_TG_SECRET_KEY, digestmod=hashlib.sha256)
 
 
 class UserSettings(BaseModel):
@@ -354,41 +441,36 @@ def verify_user_from_header(init_data: str, expected_user_id: int) -> int:
     Проверка что запрос от указанного пользователя.
     Возвращает user_id или выбрасывает HTTPException.
     """
-    from config import BOT_TOKEN, ADMIN_ID
-
     if not init_data:
         raise HTTPException(status_code=401, detail="Authorization required")
 
     # Проверяем подпись (функция определена ниже в файле)
     try:
-        params = dict(urllib.parse.parse_qsl(init_data))
-        received_hash = params.pop('hash', None)
+        pairs = urllib.parse.parse_qsl(init_data, keep_blank_values=True)
+        received_hash = next((v for k, v in pairs if k == 'hash'), None)
 
         if not received_hash:
             raise HTTPException(status_code=401, detail="Invalid init data")
 
-        data_check_string = '\n'.join(
-            f'{k}={v}' for k, v in sorted(params.items())
-        )
+        pairs = [(k, v) for k, v in pairs if k != 'hash']
+        pairs.sort()
+        # Собираем сразу bytes — без промежуточной str и .encode() целиком
+        data_check_bytes = b'\n'.join(f'{k}={v}'.encode() for k, v in pairs)
 
-        secret_key = hmac.new(
-            b'WebAppData',
-            BOT_TOKEN.encode(),
-            hashlib.sha256
-        ).digest()
+        h = _TG_BASE_HMAC.copy()
+        h.update(data_check_bytes)
 
-        calculated_hash = hmac.new(
-            secret_key,
-            data_check_string.encode(),
-            hashlib.sha256
-        ).hexdigest()
+        # Сравниваем 32 байта digest, а не 64 hex-символа
+        try:
+            received_digest = bytes.fromhex(received_hash)
+        except ValueError:
+            raise HTTPException(status_code=401, detail="Invalid signature")
 
-        if not hmac.compare_digest(calculated_hash, received_hash):
+        if not hmac.compare_digest(h.digest(), received_digest):
             raise HTTPException(status_code=401, detail="Invalid signature")
 
-        user_data = params.get('user', '{}')
-        import json as json_lib
-        user = json_lib.loads(user_data)
+        user_data = next((v for k, v in pairs if k == 'user'), '{}')
+        user = orjson.loads(user_data)
         user_id = user.get('id')
 
         if not user_id:
@@ -407,26 +489,24 @@ def verify_user_from_header(init_data: str, expected_user_id: int) -> int:
         raise HTTPException(status_code=401, detail="Authorization failed")
 
 
+_TIME_RE = re.compile(r'^([01]?[0-9]|2[0-3]):[0-5][0-9]$')
+
+
 def validate_forecast_time(time_str: str) -> bool:
     """Валидация формата времени HH:MM"""
-    import re
-    if not re.match(r'^([01]?[0-9]|2[0-3]):[0-5][0-9]$', time_str):
-        return False
-    return True
+    return _TIME_RE.match(time_str) is not None
 
 
 @app.get("/api/user/{user_id}/check")
 async def check_user(
     user_id: int,
-    x_telegram_init_data: str = FastAPIHeader(default="", alias="X-Telegram-Init-Data")
+    x_telegram_init_data: str = Header(default="", alias="X-Telegram-Init-Data")
 ):
     """
     Проверка существования пользователя и наличия натальных данных
     """
     verify_user_from_header(x_telegram_init_data, user_id)
 
-    from database.models import User
-
     user = User.get_or_none(User.telegram_id == user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -444,15 +524,13 @@ async def check_user(
 @app.get("/api/user/{user_id}/settings")
 async def get_user_settings(
     user_id: int,
-    x_telegram_init_data: str = FastAPIHeader(default="", alias="X-Telegram-Init-Data")
+    x_telegram_init_data: str = Header(default="", alias="X-Telegram-Init-Data")
 ):
     """
     Получить настройки пользователя
     """
     verify_user_from_header(x_telegram_init_data, user_id)
 
-    from database.models import User
-
     user = User.get_or_none(User.telegram_id == user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -462,8 +540,8 @@ async def get_user_settings(
         "forecast_enabled": user.push_forecast if hasattr(user, 'push_forecast') else True,
         "push_enabled": user.push_transits if hasattr(user, 'push_transits') else False,
         "user_data": {
-            "birth_date": user.birth_date.strftime("%d.%m.%Y") if user.birth_date else None,
-            "birth_time": str(user.birth_time)[:8] if user.birth_time else None,
+            "birth_date": _fmt_date(user.birth_date),
+            "birth_time": _fmt_time(user.birth_time),
             "birth_place": user.birth_place,
             "residence": user.residence_place
         }
@@ -474,15 +552,13 @@ async def get_user_settings(
 async def update_user_settings(
     user_id: int,
     settings: UserSettings,
-    x_telegram_init_data: str = FastAPIHeader(default="", alias="X-Telegram-Init-Data")
+    x_telegram_init_data: str = Header(default="", alias="X-Telegram-Init-Data")
 ):
     """
     Обновить настройки пользователя
     """
     verify_user_from_header(x_telegram_init_data, user_id)
 
-    from database.models import User
-
     user = User.get_or_none(User.telegram_id == user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -505,61 +581,70 @@ async def update_user_settings(
 
 # ============== ДЕМО-РЕЖИМ ДЛЯ ТЕСТИРОВАНИЯ ==============
 
-def parse_formula(formula: str) -> Tuple[List[int], List[int], bool]:
+# Паттерн: число(число,число) или число(число)
+_FORMULA_RE = re.compile(r'(\d+)\(([^)]+)\)')
+
+
+@lru_cache(maxsize=256)
+def parse_formula(formula: str) -> Tuple[Tuple[int, ...], Tuple[int, ...], bool]:
     """
     Парсит формулу типа "4(1,8) + 7(2,9)" или "4(1,8) - 10(3,4)"
 
+    Результат кэшируется, поэтому дома возвращаются кортежами (неизменяемые).
+
     Returns:
         (transit_houses, natal_houses, is_positive)
     """
     # Определяем знак аспекта
     is_positive = "+" in formula or "±" in formula
 
-    # Ищем паттерн: число(число,число) или число(число)
-    pattern = r'(\d+)\(([^)]+)\)'
-    matches = re.findall(pattern, formula)
+    matches = _FORMULA_RE.findall(formula)
 
     if len(matches) >= 2:
         # Первая группа - транзитная планета
         transit_main = int(matches[0][0])
-        transit_rulers = [int(x.strip()) for x in matches[0][1].split(',')]
-        transit_houses = [transit_main] + transit_rulers
+        transit_rulers = tuple(int(x.strip()) for x in matches[0][1].split(','))
+        transit_houses = (transit_main,) + transit_rulers
 
         # Вторая группа - натальная планета
         natal_main = int(matches[1][0])
-        natal_rulers = [int(x.strip()) for x in matches[1][1].split(',')]
-        natal_houses = [natal_main] + natal_rulers
+        natal_rulers = tuple(int(x.strip()) for x in matches[1][1].split(','))
+        natal_houses = (natal_main,) + natal_rulers
 
         return transit_houses, natal_houses, is_positive
 
-    return [], [], is_positive
+    return (), (), is_positive
 
 
-def get_meanings_from_formula(formula: str) -> List[str]:
-    """
-    Получает ВСЕ интерпретации для формулы
-    """
+@lru_cache(maxsize=256)
+def _meanings_from_formula(formula: str) -> Tuple[str, ...]:
+    """Кэшируемая часть get_meanings_from_formula (кортеж, чтобы кэш нельзя было испортить)"""
     transit_houses, natal_houses, is_positive = parse_formula(formula)
 
     if not transit_houses or not natal_houses:
-        return ["Информация о транзите"]
+        return ("Информация о транзите",)
 
-    meanings = analyze_transit_formula(transit_houses, natal_houses, is_positive)
+    meanings = _analyze_formula(transit_houses, natal_houses, is_positive)
 
     if not meanings:
         # Если формулы не найдены, даём общее описание
         if is_positive:
-            return ["Благоприятное время"]
+            return ("Благоприятное время",)
         else:
-            return ["Требует внимательности"]
+            return ("Требует внимательности",)
 
     return meanings
 
 
-def get_demo_forecast(target_date: date) -> DayForecast:
-    """Демо-прогноз для тестирования интерфейса"""
-    day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+def get_meanings_from_formula(formula: str) -> List[str]:
+    """
+    Получает ВСЕ интерпретации для формулы
+    """
+    return list(_meanings_from_formula(formula))
 
+
+def get_demo_forecast(target_date: date) -> dict:
+    """Демо-прогноз для тестирования интерфейса (dict по схеме DayForecast)"""
     # Тестовые транзиты как в Альтаире с реальными формулами
     demo_transit_data = [
         {
@@ -610,23 +695,14 @@ def get_demo_forecast(target_date: date) -> DayForecast:
     ]
 
     # Создаём транзиты с расшифрованными формулами
-    demo_transits = []
-    for tr in demo_transit_data:
+    demo_transits = [None] * len(demo_transit_data)
+    for i, tr in enumerate(demo_transit_data):
         meanings = get_meanings_from_formula(tr["formula"])
-        demo_transits.append(TransitItem(
-            time=tr["time"],
-            transit_planet=tr["transit_planet"],
-            natal_planet=tr["natal_planet"],
-            aspect=tr["aspect"],
-            aspect_symbol=tr["aspect_symbol"],
-            nature=tr["nature"],
-            formula=tr["formula"],
-            meanings=meanings
-        ))
+        demo_transits[i] = {**tr, "meanings": meanings}
 
     # Определяем настроение дня
-    positive = sum(1 for t in demo_transits if t.nature == "positive")
-    negative = sum(1 for t in demo_transits if t.nature == "negative")
+    positive = sum(1 for t in demo_transits if t["nature"] == "positive")
+    negative = sum(1 for t in demo_transits if t["nature"] == "negative")
 
     if positive > negative:
         mood = "good"
@@ -635,30 +711,71 @@ def get_demo_forecast(target_date: date) -> DayForecast:
     else:
         mood = "neutral"
 
-    return DayForecast(
-        date=target_date.strftime("%d.%m.%Y"),
-        day_name=day_names[target_date.weekday()],
-        transits=demo_transits,
-        summary="До 12:40 хорошее время для общения и переговоров. С 13:18 до 15:18 не лучшее время для важных решений — лучше отложить серьёзные разговоры. Вечером творческое настроение, хорошее время для романтики.",
-        mood=mood
-    )
+    return {
+        "date": _fmt_date(target_date),
+        "day_name": _DAY_NAMES[target_date.weekday()],
+        "transits": demo_transits,
+        "summary": "До 12:40 хорошее время для общения и переговоров. С 13:18 до 15:18 не лучшее время для важных решений — лучше отложить серьёзные разговоры. Вечером творческое настроение, хорошее время для романтики.",
+        "mood": mood
+    }
 
 
-@app.get("/api/demo/forecast/today")
+@app.get("/api/demo/forecast/today", response_model=None)
 async def get_demo_today():
     """Демо-прогноз на сегодня"""
     return get_demo_forecast(date.today())
 
 
-@app.get("/api/forecast/{user_id}/today")
+# Готовые summary от LLM: {(user_id, дата, тип, transits_text): (истекает (monotonic), summary)}
+_SUMMARY_CACHE_TTL = 3600  # секунд
+_SUMMARY_CACHE_MAX = 1024
+_summary_cache: Dict[tuple, Tuple[float, str]] = {}
+
+# Summary для дня без транзитов — LLM для этого не нужен
+NO_TRANSITS_SUMMARY = "Особых указаний нет, день проходит в обычном режиме."
+
+
+async def get_forecast_summary(
+    user_id: int,
+    day: date,
+    transits: List[dict],
+    transits_text: str,
+    user_name: str = "",
+    forecast_type: str = "daily",
+    target_date: str = None
+) -> str:
+    """
+    Текст прогноза от LLM с коротким кэшем.
+    Без транзитов возвращает NO_TRANSITS_SUMMARY без запроса к LLM.
+    """
+    if not transits:
+        return NO_TRANSITS_SUMMARY
+
+    key = (user_id, day, forecast_type, transits_text)
+    now = time.monotonic()
+    cached = _summary_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    summary = await generate_forecast(
+        transits_data=transits_text,
+        transits_list=transits,
+        user_name=user_name,
+        forecast_type=forecast_type,
+        target_date=target_date
+    )
+
+    if len(_summary_cache) >= _SUMMARY_CACHE_MAX:
+        _summary_cache.clear()
+    _summary_cache[key] = (now + _SUMMARY_CACHE_TTL, summary)
+    return summary
+
+
+@app.get("/api/forecast/{user_id}/today", response_model=None)
 async def get_today_forecast(user_id: int):
     """
     Получить прогноз на сегодня
     """
-    from database.models import User
-    from services.astro_engine import calculate_local_natal, calculate_transits, format_transits_text
-    from services.groq_client import generate_forecast
-    from services.geocoder import get_timezone_offset
 
     try:
         user = User.get_or_none(User.telegram_id == user_id)
@@ -695,40 +812,33 @@ async def get_today_forecast(user_id: int):
         )
 
         # Фильтруем транзиты по времени: оставляем только с 6:00 до 23:55
-        from datetime import time as dt_time
-        transits_filtered = []
-        for tr in transits:
-            exact_dt = tr.get('exact_datetime')
-            if exact_dt:
-                t = exact_dt.time()
-                # Включаем транзиты с 06:00 до 23:55
-                if dt_time(6, 0) <= t <= dt_time(23, 55):
-                    transits_filtered.append(tr)
-        transits = transits_filtered if transits_filtered else transits  # fallback если всё отфильтровалось
+        transits = filter_day_transits(transits)
 
         transits_text = format_transits_text(transits)
 
-        summary = await generate_forecast(
-            transits_data=transits_text,
-            transits_list=transits,
+        summary = await get_forecast_summary(
+            user_id, today, transits, transits_text,
             user_name=user.display_name,
             forecast_type="daily"
         )
 
-        transit_items = []
-        for tr in transits:
+        transit_items = [None] * len(transits)
+        positive_count = negative_count = 0
+        for i, tr in enumerate(transits):
             # Используем функцию для определения природы аспекта с учётом злых планет
             transit_planet = tr.get('transit_planet', '')
             natal_planet = tr.get('natal_planet', '')
             aspect_name = tr.get('aspect_name', '')
             nature, is_positive = determine_aspect_nature(aspect_name, transit_planet, natal_planet)
+            if nature == "positive":
+                positive_count += 1
+            elif nature == "negative":
+                negative_count += 1
 
-            transit_houses = [tr.get('transit_house', 0)] + (tr.get('transit_rules', []) or [])
-            natal_houses = [tr.get('natal_house', 0)] + (tr.get('natal_rules', []) or [])
-            transit_houses = [h for h in transit_houses if h]
-            natal_houses = [h for h in natal_houses if h]
+            transit_houses = _merge_houses(tr.get('transit_house', 0), tr.get('transit_rules'))
+            natal_houses = _merge_houses(tr.get('natal_house', 0), tr.get('natal_rules'))
 
-            meanings = analyze_transit_formula(transit_houses, natal_houses, is_positive)
+            meanings = list(_analyze_formula(transit_houses, natal_houses, is_positive))
             if not meanings:
                 meanings = ["Благоприятное время" if is_positive else "Требует внимательности"]
 
@@ -741,21 +851,20 @@ async def get_today_forecast(user_id: int):
             )
 
             exact_dt = tr.get('exact_datetime')
-            time_str = exact_dt.strftime("%H:%M") if exact_dt else ""
-
-            transit_items.append(TransitItem(
-                time=time_str,
-                transit_planet=tr.get('transit_planet', ''),
-                natal_planet=tr.get('natal_planet', ''),
-                aspect=aspect_name,
-                aspect_symbol=tr.get('aspect_symbol', ''),
-                nature=nature,
-                formula=formula_display,
-                meanings=meanings
-            ))
-
-        positive_count = sum(1 for t in transit_items if t.nature == "positive")
-        negative_count = sum(1 for t in transit_items if t.nature == "negative")
+            time_str = f"{exact_dt.hour:02d}:{exact_dt.minute:02d}" if exact_dt else ""
+
+            # Данные уже готовые — собираем dict по схеме TransitItem без валидации pydantic
+            transit_items[i] = {
+                "time": time_str,
+                "transit_planet": transit_planet,
+                "natal_planet": natal_planet,
+                "aspect": aspect_name,
+                "aspect_symbol": tr.get('aspect_symbol', ''),
+                "nature": nature,
+                "formula": formula_display,
+                "meanings": meanings
+            }
+
         if positive_count > negative_count:
             mood = "good"
         elif negative_count > positive_count:
@@ -763,20 +872,18 @@ async def get_today_forecast(user_id: int):
         else:
             mood = "neutral"
 
-        day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
-
         # Данные пользователя для отображения
         user_data = {
-            "birth_date": user.birth_date.strftime("%d.%m.%Y") if user.birth_date else None,
-            "birth_time": str(user.birth_time)[:8] if user.birth_time else None,
+            "birth_date": _fmt_date(user.birth_date),
+            "birth_time": _fmt_time(user.birth_time),
             "birth_place": user.birth_place,
             "residence": user.residence_place
         }
 
         return {
-            "date": today.strftime("%d.%m.%Y"),
-            "day_name": day_names[today.weekday()],
-            "transits": [t.model_dump() for t in transit_items],
+            "date": _fmt_date(today),
+            "day_name": _DAY_NAMES[today.weekday()],
+            "transits": transit_items,
             "summary": summary,
             "mood": mood,
             "user_data": user_data
@@ -789,7 +896,7 @@ async def get_today_forecast(user_id: int):
         raise HTTPException(status_code=500, detail=get_api_error(e))
 
 
-@app.get("/api/forecast/{user_id}/calendar")
+@app.get("/api/forecast/{user_id}/calendar", response_model=None)
 async def get_calendar(
     user_id: int,
     year: int = Query(default=None),
@@ -801,10 +908,6 @@ async def get_calendar(
     Данные кэшируются в БД на 30 дней.
     Дни после окончания подписки помечаются как locked.
     """
-    from database.models import User, CalendarCache
-    from services.astro_engine import calculate_local_natal, calculate_transits
-    from services.geocoder import get_timezone_offset
-    from datetime import datetime
 
     try:
         user = User.get_or_none(User.telegram_id == user_id)
@@ -853,7 +956,6 @@ async def get_calendar(
                         day["locked"] = False
 
                 # Получаем лунные фазы из БД (мгновенно)
-                from database.models import MoonPhase
                 moon_phases = []
 
                 phases_db = MoonPhase.select().where(
@@ -864,7 +966,7 @@ async def get_calendar(
                 for phase in phases_db:
                     moon_phases.append({
                         "type": phase.phase_type,
-                        "date": phase.phase_date.strftime("%d.%m.%Y"),
+                        "date": _fmt_date(phase.phase_date),
                         "time": phase.phase_time
                     })
 
@@ -873,7 +975,7 @@ async def get_calendar(
                     "month": month,
                     "days": cached_days,
                     "moon_phases": moon_phases,
-                    "subscription_end": subscription_end.strftime("%d.%m.%Y") if subscription_end else None,
+                    "subscription_end": _fmt_date(subscription_end),
                     "from_cache": True
                 }
 
@@ -921,34 +1023,28 @@ async def get_calendar(
                 transit_cusps_tz=display_tz_hours
             )
 
-        # Группируем транзиты по дням
-        days_data = {}
+        # Группируем транзиты по дням: ordinal дня -> [positive, negative, neutral]
+        # (строку даты форматируем только при выводе — по разу на день, а не на транзит)
+        days_data = defaultdict(lambda: [0, 0, 0])
         for tr in transits:
             exact_dt = tr.get('exact_datetime')
             if not exact_dt:
                 continue
-            day_str = exact_dt.strftime("%d.%m.%Y")
-            if day_str not in days_data:
-                days_data[day_str] = {"positive": 0, "negative": 0, "neutral": 0}
+            day_key = exact_dt.toordinal()
 
             # Определяем природу аспекта с учётом злых планет
-            transit_planet = tr.get('transit_planet', '')
-            natal_planet = tr.get('natal_planet', '')
-            aspect_name = tr.get('aspect_name', '')
-            nature, _ = determine_aspect_nature(aspect_name, transit_planet, natal_planet)
-
-            if nature == "positive":
-                days_data[day_str]["positive"] += 1
-            elif nature == "negative":
-                days_data[day_str]["negative"] += 1
-            else:
-                days_data[day_str]["neutral"] += 1
+            nature, _ = determine_aspect_nature(
+                tr.get('aspect_name', ''),
+                tr.get('transit_planet', ''),
+                tr.get('natal_planet', '')
+            )
+            days_data[day_key][_NATURE_INDEX.get(nature, 2)] += 1
 
         # Формируем ответ для всех дней месяца
         calendar_days = []
         for day_offset in range(days_count):
             current_date = first_day + timedelta(days=day_offset)
-            day_str = current_date.strftime("%d.%m.%Y")
+            day_str = _fmt_date(current_date)
 
             # Проверяем, заблокирован ли день
             is_locked = False
@@ -967,12 +1063,12 @@ async def get_calendar(
                     "locked": True
                 })
             else:
-                day_info = days_data.get(day_str, {"positive": 0, "negative": 0, "neutral": 0})
-                transit_count = day_info["positive"] + day_info["negative"] + day_info["neutral"]
+                pos, neg, neu = days_data.get(current_date.toordinal(), (0, 0, 0))
+                transit_count = pos + neg + neu
 
-                if day_info["positive"] > day_info["negative"]:
+                if pos > neg:
                     mood = "good"
-                elif day_info["negative"] > day_info["positive"]:
+                elif neg > pos:
                     mood = "difficult"
                 else:
                     mood = "neutral"
@@ -986,7 +1082,6 @@ async def get_calendar(
                 })
 
         # Получаем лунные фазы из БД (предрасчитанные)
-        from database.models import MoonPhase
         moon_phases = []
 
         phases_db = MoonPhase.select().where(
@@ -997,7 +1092,7 @@ async def get_calendar(
         for phase in phases_db:
             moon_phases.append({
                 "type": phase.phase_type,
-                "date": phase.phase_date.strftime("%d.%m.%Y"),
+                "date": _fmt_date(phase.phase_date),
                 "time": phase.phase_time
             })
 
@@ -1010,7 +1105,7 @@ async def get_calendar(
             "month": month,
             "days": calendar_days,
             "moon_phases": moon_phases,  # Добавляем лунные фазы
-            "subscription_end": subscription_end.strftime("%d.%m.%Y") if subscription_end else None,
+            "subscription_end": _fmt_date(subscription_end),
             "from_cache": False
         }
 
@@ -1021,33 +1116,123 @@ async def get_calendar(
         raise HTTPException(status_code=500, detail=get_api_error(e))
 
 
+def _merge_houses(main: int, rules: Optional[List[int]]) -> Tuple[int, ...]:
+    """Дом планеты + управляемые дома одним кортежем, без нулей/None"""
+    out = [main] if main else []
+    if rules:
+        for h in rules:
+            if h:
+                out.append(h)
+    return tuple(out)
+
+
+@lru_cache(maxsize=4096)
+def _analyze_formula(transit_houses: Tuple[int, ...], natal_houses: Tuple[int, ...],
+                     is_positive: bool) -> Tuple[str, ...]:
+    """
+    analyze_transit_formula с кэшем: комбинаций домов немного (12 домов × управители × знак),
+    в течение дня и между пользователями они повторяются.
+    """
+    return tuple(analyze_transit_formula(list(transit_houses), list(natal_houses), is_positive))
+
+
 def format_formula_display(transit_house: int, transit_rules: List[int],
                           natal_house: int, natal_rules: List[int],
                           is_positive: bool) -> str:
     """Форматирует формулу в виде 4(1,8) + 7(2,9)"""
+    return _format_formula(
+        transit_house, tuple(transit_rules or ()),
+        natal_house, tuple(natal_rules or ()),
+        is_positive
+    )
+
+
+@lru_cache(maxsize=4096)
+def _format_formula(transit_house: int, transit_rules: Tuple[int, ...],
+                    natal_house: int, natal_rules: Tuple[int, ...],
+                    is_positive: bool) -> str:
+    """Кэшируемая часть format_formula_display (аргументы — кортежи)"""
     sign = "+" if is_positive else "-"
 
     # Транзитная часть
-    t_rules_str = ",".join(str(r) for r in transit_rules) if transit_rules else ""
+    t_rules_str = ",".join(map(str, transit_rules)) if transit_rules else ""
     t_part = f"{transit_house}({t_rules_str})" if t_rules_str else str(transit_house)
 
     # Натальная часть
-    n_rules_str = ",".join(str(r) for r in natal_rules) if natal_rules else ""
+    n_rules_str = ",".join(map(str, natal_rules)) if natal_rules else ""
     n_part = f"{natal_house}({n_rules_str})" if n_rules_str else str(natal_house)
 
     return f"{t_part} {sign} {n_part}"
 
 
+def _build_transit_items(transits: List[dict]) -> Tuple[List[dict], str]:
+    """
+    Элементы прогноза (dict по схеме TransitItem) и настроение дня за один проход.
+
+    Returns:
+        (transit_items, mood)
+    """
+    transit_items = [None] * len(transits)
+    positive_count = negative_count = 0
+    for i, tr in enumerate(transits):
+        # Используем функцию для определения природы аспекта с учётом злых планет
+        transit_planet = tr.get('transit_planet', '')
+        natal_planet = tr.get('natal_planet', '')
+        aspect_name = tr.get('aspect_name', '')
+        nature, is_positive = determine_aspect_nature(aspect_name, transit_planet, natal_planet)
+        if nature == "positive":
+            positive_count += 1
+        elif nature == "negative":
+            negative_count += 1
+
+        # Собираем дома для расшифровки
+        transit_houses = _merge_houses(tr.get('transit_house', 0), tr.get('transit_rules'))
+        natal_houses = _merge_houses(tr.get('natal_house', 0), tr.get('natal_rules'))
+
+        # Расшифровка формул
+        meanings = list(_analyze_formula(transit_houses, natal_houses, is_positive))
+        if not meanings:
+            meanings = ["Благоприятное время" if is_positive else "Требует внимательности"]
+
+        # Формула для отображения
+        formula_display = format_formula_display(
+            tr.get('transit_house', 0),
+            tr.get('transit_rules', []),
+            tr.get('natal_house', 0),
+            tr.get('natal_rules', []),
+            is_positive
+        )
+
+        # Время
+        exact_dt = tr.get('exact_datetime')
+        time_str = f"{exact_dt.hour:02d}:{exact_dt.minute:02d}" if exact_dt else ""
+
+        transit_items[i] = {
+            "time": time_str,
+            "transit_planet": transit_planet,
+            "natal_planet": natal_planet,
+            "aspect": aspect_name,
+            "aspect_symbol": tr.get('aspect_symbol', ''),
+            "nature": nature,
+            "formula": formula_display,
+            "meanings": meanings
+        }
+
+    if positive_count > negative_count:
+        mood = "good"
+    elif negative_count > positive_count:
+        mood = "difficult"
+    else:
+        mood = "neutral"
+
+    return transit_items, mood
+
+
 @app.get("/api/forecast/{user_id}/date/{date_str}")
 async def get_date_forecast(user_id: int, date_str: str):
     """
     Получить прогноз на конкретную дату
     """
-    from datetime import datetime
-    from database.models import User
-    from services.astro_engine import calculate_local_natal, calculate_transits, format_transits_text
-    from services.groq_client import generate_forecast
-    from services.geocoder import get_timezone_offset
 
     try:
         # Парсим дату
@@ -1068,7 +1253,9 @@ async def get_date_forecast(user_id: int, date_str: str):
         # TZ для отображения времени транзитов (место проживания)
         display_tz_hours = get_timezone_offset(user.residence_tz or user.birth_tz or "Europe/Moscow", target_date)
 
-        natal = calculate_local_natal(
+        # Расчёты Swiss Ephemeris синхронные и тяжёлые — в пул потоков, чтобы не блокировать event loop
+        natal = await asyncio.to_thread(
+            calculate_local_natal,
             birth_date=user.birth_date,
             birth_time=user.birth_time,
             birth_lat=user.birth_lat,
@@ -1078,7 +1265,8 @@ async def get_date_forecast(user_id: int, date_str: str):
             timezone_hours=birth_tz_hours  # TZ рождения для натальной карты
         )
 
-        transits = calculate_transits(
+        transits = await asyncio.to_thread(
+            calculate_transits,
             natal_data=natal,
             start_date=target_date,
             days=1,
@@ -1089,93 +1277,35 @@ async def get_date_forecast(user_id: int, date_str: str):
         )
 
         # Фильтруем транзиты по времени: оставляем только с 6:00 до 23:55
-        from datetime import time as dt_time
-        transits_filtered = []
-        for tr in transits:
-            exact_dt = tr.get('exact_datetime')
-            if exact_dt:
-                t = exact_dt.time()
-                # Включаем транзиты с 06:00 до 23:55
-                if dt_time(6, 0) <= t <= dt_time(23, 55):
-                    transits_filtered.append(tr)
-        transits = transits_filtered if transits_filtered else transits  # fallback если всё отфильтровалось
+        transits = filter_day_transits(transits)
 
-        transits_text = format_transits_text(transits)
+        transits_text = await asyncio.to_thread(format_transits_text, transits)
+
+        # Транзиты для ответа от summary не зависят — собираем их в пуле потоков,
+        # пока идёт LLM-запрос (клиент Groq синхронный и держит event loop до ответа)
+        items_future = asyncio.get_running_loop().run_in_executor(None, _build_transit_items, transits)
 
-        summary = await generate_forecast(
-            transits_data=transits_text,
-            transits_list=transits,
+        summary = await get_forecast_summary(
+            user_id, target_date, transits, transits_text,
             user_name=user.display_name,
             forecast_type="date",
-            target_date=target_date.strftime("%d.%m.%Y")
+            target_date=_fmt_date(target_date)
         )
 
-        transit_items = []
-        for tr in transits:
-            # Используем функцию для определения природы аспекта с учётом злых планет
-            transit_planet = tr.get('transit_planet', '')
-            natal_planet = tr.get('natal_planet', '')
-            aspect_name = tr.get('aspect_name', '')
-            nature, is_positive = determine_aspect_nature(aspect_name, transit_planet, natal_planet)
-
-            # Собираем дома для расшифровки
-            transit_houses = [tr.get('transit_house', 0)] + (tr.get('transit_rules', []) or [])
-            natal_houses = [tr.get('natal_house', 0)] + (tr.get('natal_rules', []) or [])
-            transit_houses = [h for h in transit_houses if h]
-            natal_houses = [h for h in natal_houses if h]
-
-            # Расшифровка формул
-            meanings = analyze_transit_formula(transit_houses, natal_houses, is_positive)
-            if not meanings:
-                meanings = ["Благоприятное время" if is_positive else "Требует внимательности"]
-
-            # Формула для отображения
-            formula_display = format_formula_display(
-                tr.get('transit_house', 0),
-                tr.get('transit_rules', []),
-                tr.get('natal_house', 0),
-                tr.get('natal_rules', []),
-                is_positive
-            )
-
-            # Время
-            exact_dt = tr.get('exact_datetime')
-            time_str = exact_dt.strftime("%H:%M") if exact_dt else ""
-
-            transit_items.append(TransitItem(
-                time=time_str,
-                transit_planet=tr.get('transit_planet', ''),
-                natal_planet=tr.get('natal_planet', ''),
-                aspect=aspect_name,
-                aspect_symbol=tr.get('aspect_symbol', ''),
-                nature=nature,
-                formula=formula_display,
-                meanings=meanings
-            ))
-
-        positive_count = sum(1 for t in transit_items if t.nature == "positive")
-        negative_count = sum(1 for t in transit_items if t.nature == "negative")
-        if positive_count > negative_count:
-            mood = "good"
-        elif negative_count > positive_count:
-            mood = "difficult"
-        else:
-            mood = "neutral"
-
-        day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+        transit_items, mood = await items_future
 
         # Данные пользователя для отображения
         user_data = {
-            "birth_date": user.birth_date.strftime("%d.%m.%Y") if user.birth_date else None,
-            "birth_time": str(user.birth_time)[:8] if user.birth_time else None,
+            "birth_date": _fmt_date(user.birth_date),
+            "birth_time": _fmt_time(user.birth_time),
             "birth_place": user.birth_place,
             "residence": user.residence_place
         }
 
         return {
-            "date": target_date.strftime("%d.%m.%Y"),
-            "day_name": day_names[target_date.weekday()],
-            "transits": [t.model_dump() for t in transit_items],
+            "date": _fmt_date(target_date),
+            "day_name": _DAY_NAMES[target_date.weekday()],
+            "transits": transit_items,
             "summary": summary,
             "mood": mood,
             "user_data": user_data
@@ -1197,8 +1327,6 @@ async def ask_forecast_question(user_id: int, question_data: ForecastQuestion):
     AI ответит на основе данных прогноза этого дня.
     """
     try:
-        from database.models import User
-        from services.groq_client import ask_forecast
 
         user = User.get_or_none(User.telegram_id == user_id)
         if not user:
@@ -1226,33 +1354,39 @@ async def ask_forecast_question(user_id: int, question_data: ForecastQuestion):
 
 # ============== СТАТИКА MINI APP ==============
 
-# Монтируем статику
-if WEBAPP_DIR.exists():
-    app.mount("/static", StaticFiles(directory=str(WEBAPP_DIR)), name="static")
+# Ассеты со строкой версии (style.css?v=28) не меняются — браузер может не перезапрашивать
+_IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+
+class WebappStaticFiles(StaticFiles):
+    """StaticFiles с долгим кэшем для версионированных файлов Mini App"""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if status_code == 200 and "v" in QueryParams(scope["query_string"]):
+            response.headers["Cache-Control"] = _IMMUTABLE_CACHE
+        return response
 
 
 @app.get("/webapp")
 async def webapp_index():
-    """Главная страница Mini App"""
+    """Главная страница Mini App (бот открывает /webapp без слэша — без редиректа на /webapp/)"""
     index_path = WEBAPP_DIR / "index.html"
     if index_path.exists():
         return FileResponse(str(index_path))
     raise HTTPException(status_code=404, detail="Mini App not found")
 
 
-@app.get("/webapp/{path:path}")
-async def webapp_files(path: str):
-    """Файлы Mini App"""
-    file_path = WEBAPP_DIR / path
-    if file_path.exists() and file_path.is_file():
-        return FileResponse(str(file_path))
-    raise HTTPException(status_code=404, detail="File not found")
+# Монтируем статику. StaticFiles отдаёт файлы через sendfile и сам ставит
+# ETag/Last-Modified, так что повторные запросы получают 304;
+# html=True отдаёт index.html на /webapp/
+if WEBAPP_DIR.exists():
+    app.mount("/static", StaticFiles(directory=str(WEBAPP_DIR)), name="static")
+    app.mount("/webapp", WebappStaticFiles(directory=str(WEBAPP_DIR), html=True), name="webapp")
 
 
 # ============== ADMIN API ==============
 
-from config import ADMIN_ID
-
 # Простая проверка админа по ID из заголовка
 def verify_admin(admin_id: int = Query(..., alias="admin_id")):
     """Проверка прав администратора"""
@@ -1288,10 +1422,30 @@ async def admin_stats(admin_id: int = Query(...)):
     """Статистика для админ-панели"""
     verify_admin(admin_id)
 
-    from database.models import get_stats
     return get_stats()
 
 
+# Общее число пользователей (без фильтров) — кэш на 60 секунд: [истекает (monotonic), количество]
+_USERS_TOTAL_TTL = 60
+_users_total_cache = [0.0, 0]
+
+
+def _cached_users_total() -> int:
+    """COUNT(*) по users не чаще раза в _USERS_TOTAL_TTL секунд"""
+    now = time.monotonic()
+    if now >= _users_total_cache[0]:
+        _users_total_cache[:] = [now + _USERS_TOTAL_TTL, User.select().count()]
+    return _users_total_cache[1]
+
+
+def _user_search_condition(search: str):
+    """Поиск по подстроке в имени/username; для числа — ещё и точное совпадение telegram_id"""
+    conds = [User.first_name.contains(search), User.username.contains(search)]
+    if search.isdigit():
+        conds.append(User.telegram_id == int(search))
+    return reduce(operator.or_, conds)
+
+
 @app.get("/api/admin/users")
 async def admin_users_list(
     admin_id: int = Query(...),
@@ -1303,9 +1457,7 @@ async def admin_users_list(
     """Список пользователей с пагинацией и фильтрацией"""
     verify_admin(admin_id)
 
-    from database.models import User, Subscription
-    from datetime import datetime
-
+    now = datetime.now()
     query = User.select()
 
     # Фильтрация
@@ -1314,46 +1466,51 @@ async def admin_users_list(
     elif filter_type == "without_data":
         query = query.where(User.natal_data_complete == False)
     elif filter_type == "with_subscription":
-        # Пользователи с активной подпиской
-        active_sub_users = (
-            Subscription.select(Subscription.user)
+        # Пользователи с активной подпиской (JOIN вместо IN (подзапрос))
+        query = (
+            query.join(Subscription)
             .where(
                 Subscription.status.in_(['active', 'expiring_soon']),
-                Subscription.expires_at > datetime.now()
+                Subscription.expires_at > now
             )
+            .group_by(User.telegram_id)
         )
-        query = query.where(User.telegram_id.in_(active_sub_users))
 
-    # Поиск
     if search:
-        search_term = f"%{search}%"
-        query = query.where(
-            (User.first_name.contains(search)) |
-            (User.username.contains(search)) |
-            (User.telegram_id == int(search) if search.isdigit() else False)
-        )
+        query = query.where(_user_search_condition(search))
 
-    # Подсчёт общего количества
-    total = query.count()
-
-    # Пагинация
+    # Пагинация: берём limit + 1 строк — лишняя строка говорит, есть ли следующая страница
     offset = (page - 1) * limit
-    users = query.order_by(User.created_at.desc()).offset(offset).limit(limit)
+    users = list(query.order_by(User.created_at.desc()).offset(offset).limit(limit + 1))
+    has_next = len(users) > limit
+    users = users[:limit]
+
+    # Общее количество: на последней странице оно известно без COUNT,
+    # без фильтров — из кэша, иначе отдельный COUNT
+    if not has_next and (users or page == 1):
+        total = offset + len(users)
+    elif not filter_type and not search:
+        total = _cached_users_total()
+    else:
+        total = query.count()
+
+    # Подписки всей страницы одним запросом (без N+1)
+    subs = Subscription.get_current_for_users([u.telegram_id for u in users])
 
     users_list = []
     for user in users:
-        sub = user.get_subscription()
+        sub = subs.get(user.telegram_id)
         users_list.append({
             "telegram_id": user.telegram_id,
             "username": user.username,
             "first_name": user.first_name,
-            "birth_date": user.birth_date.strftime("%d.%m.%Y") if user.birth_date else None,
+            "birth_date": _fmt_date(user.birth_date),
             "birth_place": user.birth_place,
             "natal_data_complete": user.natal_data_complete,
             "is_admin": user.is_admin,
             "subscription_status": sub.status if sub else None,
-            "subscription_expires": sub.expires_at.strftime("%d.%m.%Y") if sub and sub.expires_at else None,
-            "created_at": user.created_at.strftime("%d.%m.%Y %H:%M")
+            "subscription_expires": _fmt_date(sub.expires_at) if sub else None,
+            "created_at": _fmt_dt(user.created_at)
         })
 
     return {
@@ -1361,6 +1518,7 @@ async def admin_users_list(
         "page": page,
         "limit": limit,
         "pages": (total + limit - 1) // limit,
+        "has_next": has_next,
         "users": users_list
     }
 
@@ -1370,8 +1528,6 @@ async def admin_get_user(user_id: int, admin_id: int = Query(...)):
     """Получить полные данные пользователя"""
     verify_admin(admin_id)
 
-    from database.models import User
-
     user = User.get_or_none(User.telegram_id == user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -1382,8 +1538,8 @@ async def admin_get_user(user_id: int, admin_id: int = Query(...)):
         "telegram_id": user.telegram_id,
         "username": user.username,
         "first_name": user.first_name,
-        "birth_date": user.birth_date.strftime("%d.%m.%Y") if user.birth_date else None,
-        "birth_time": str(user.birth_time)[:8] if user.birth_time else None,
+        "birth_date": _fmt_date(user.birth_date),
+        "birth_time": _fmt_time(user.birth_time),
         "birth_place": user.birth_place,
         "birth_lat": user.birth_lat,
         "birth_lon": user.birth_lon,
@@ -1399,12 +1555,12 @@ async def admin_get_user(user_id: int, admin_id: int = Query(...)):
         "questions_today": user.questions_today,
         "subscription": {
             "status": sub.status,
-            "started_at": sub.started_at.strftime("%d.%m.%Y") if sub and sub.started_at else None,
-            "expires_at": sub.expires_at.strftime("%d.%m.%Y %H:%M") if sub and sub.expires_at else None,
+            "started_at": _fmt_date(sub.started_at) if sub else None,
+            "expires_at": _fmt_dt(sub.expires_at) if sub else None,
             "days_left": sub.days_left if sub else 0
         } if sub else None,
-        "created_at": user.created_at.strftime("%d.%m.%Y %H:%M"),
-        "updated_at": user.updated_at.strftime("%d.%m.%Y %H:%M")
+        "created_at": _fmt_dt(user.created_at),
+        "updated_at": _fmt_dt(user.updated_at)
     }
 
 
@@ -1413,9 +1569,6 @@ async def admin_update_user(user_id: int, data: AdminUserUpdate, admin_id: int =
     """Обновить данные пользователя"""
     verify_admin(admin_id)
 
-    from database.models import User, CalendarCache
-    from datetime import datetime
-
     user = User.get_or_none(User.telegram_id == user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -1491,8 +1644,6 @@ async def admin_manage_subscription(user_id: int, data: AdminSubscriptionCreate,
     """Создать или продлить подписку"""
     verify_admin(admin_id)
 
-    from database.models import User, Subscription
-
     user = User.get_or_none(User.telegram_id == user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -1516,8 +1667,6 @@ async def admin_cancel_subscription(user_id: int, admin_id: int = Query(...)):
     """Отменить подписку"""
     verify_admin(admin_id)
 
-    from database.models import User
-
     user = User.get_or_none(User.telegram_id == user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -1530,6 +1679,28 @@ async def admin_cancel_subscription(user_id: int, admin_id: int = Query(...)):
     return {"status": "ok", "message": "Subscription cancelled"}
 
 
+# Удаления выполняются в потоке: в WAL-режиме читатели не ждут писателя,
+# и event loop продолжает обслуживать другие запросы, пока идёт сброс.
+# connection_context возвращает соединение потока в пул после сброса
+
+@db.connection_context()
+def _reset_user_data(user: User) -> Tuple[int, int]:
+    """Удалить кэш календаря и прогнозы пользователя одной транзакцией"""
+    with db.atomic():
+        deleted_cache = CalendarCache.invalidate_for_user(user.telegram_id)
+        deleted_forecasts = Forecast.delete().where(Forecast.user == user).execute()
+    return deleted_cache, deleted_forecasts
+
+
+@db.connection_context()
+def _reset_all_data() -> Tuple[int, int]:
+    """Удалить весь кэш календаря и все прогнозы одной транзакцией"""
+    with db.atomic():
+        deleted_cache = CalendarCache.delete().execute()
+        deleted_forecasts = Forecast.delete().execute()
+    return deleted_cache, deleted_forecasts
+
+
 @app.post("/api/admin/recalculate")
 async def admin_recalculate_cache(
     admin_id: int = Query(...),
@@ -1549,16 +1720,13 @@ async def admin_recalculate_cache(
     """
     verify_admin(admin_id)
 
-    from database.models import CalendarCache, Forecast, User
-
     if user_id:
         # Очистка данных конкретного пользователя
         user = User.get_or_none(User.telegram_id == user_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        deleted_cache = CalendarCache.invalidate_for_user(user_id)
-        deleted_forecasts = Forecast.delete().where(Forecast.user == user).execute()
+        deleted_cache, deleted_forecasts = await asyncio.to_thread(_reset_user_data, user)
 
         logger.info(f"Admin {admin_id} reset data for user {user_id}: cache={deleted_cache}, forecasts={deleted_forecasts}")
         return {
@@ -1569,8 +1737,7 @@ async def admin_recalculate_cache(
         }
     else:
         # Очистка ВСЕХ данных ВСЕХ пользователей
-        deleted_cache = CalendarCache.delete().execute()
-        deleted_forecasts = Forecast.delete().execute()
+        deleted_cache, deleted_forecasts = await asyncio.to_thread(_reset_all_data)
 
         logger.info(f"Admin {admin_id} reset ALL data: cache={deleted_cache}, forecasts={deleted_forecasts}")
         return {
@@ -1589,8 +1756,6 @@ async def admin_subscriptions_list(
     """Список подписок"""
     verify_admin(admin_id)
 
-    from database.models import Subscription, User
-
     query = Subscription.select(Subscription, User).join(User)
 
     if status:
@@ -1604,8 +1769,8 @@ async def admin_subscriptions_list(
             "username": sub.user.username,
             "first_name": sub.user.first_name,
             "status": sub.status,
-            "started_at": sub.started_at.strftime("%d.%m.%Y") if sub.started_at else None,
-            "expires_at": sub.expires_at.strftime("%d.%m.%Y %H:%M") if sub.expires_at else None,
+            "started_at": _fmt_date(sub.started_at),
+            "expires_at": _fmt_dt(sub.expires_at),
             "days_left": sub.days_left,
             "amount": float(sub.amount) if sub.amount else None
         })
@@ -1629,12 +1794,8 @@ async def admin_index():
 # ============== ADMIN API (совместимый с admin-webapp HTML) ==============
 # Эти эндпоинты используют X-Telegram-Init-Data для авторизации
 
-import hashlib
-import hmac
-import urllib.parse
-import json as json_module
 
-def verify_telegram_init_data(init_data: str, bot_token: str) -> dict:
+def verify_telegram_init_data(init_data: str) -> dict:
     """
     Проверка подписи Telegram initData по документации.
     https://core.telegram.org/bots/webapps#validating-data-received-via-the-mini-app
@@ -1643,57 +1804,69 @@ def verify_telegram_init_data(init_data: str, bot_token: str) -> dict:
         return None
 
     try:
-        # Парсим параметры
-        params = dict(urllib.parse.parse_qsl(init_data))
-        received_hash = params.pop('hash', None)
+        # Парсим параметры, за один проход отделяя hash
+        received_hash = None
+        user_data = '{}'
+        params = []
+        for k, v in urllib.parse.parse_qsl(init_data):
+            if k == 'hash':
+                received_hash = v
+                continue
+            if k == 'user':
+                user_data = v
+            params.append((k, v))
 
         if not received_hash:
             return None
 
         # Создаём строку для проверки (сортированные параметры)
-        data_check_string = '\n'.join(
-            f'{k}={v}' for k, v in sorted(params.items())
-        )
+        params.sort()
+        data_check_bytes = b'\n'.join([f'{k}={v}'.encode() for k, v in params])
 
-        # Создаём секретный ключ
-        secret_key = hmac.new(
-            b'WebAppData',
-            bot_token.encode(),
-            hashlib.sha256
-        ).digest()
-
-        # Вычисляем хеш
-        calculated_hash = hmac.new(
-            secret_key,
-            data_check_string.encode(),
-            hashlib.sha256
-        ).hexdigest()
-
-        # Сравниваем
-        if not hmac.compare_digest(calculated_hash, received_hash):
+        # Вычисляем хеш (HMAC с ключом от BOT_TOKEN подготовлен при импорте)
+        h = _TG_BASE_HMAC.copy()
+        h.update(data_check_bytes)
+        calculated_hash = h.digest()
+
+        # Сравниваем сырые байты, без hex-кодирования
+        try:
+            received = bytes.fromhex(received_hash)
+        except ValueError:
+            return None
+        if not hmac.compare_digest(calculated_hash, received):
             return None
 
         # Парсим user data
-        user_data = params.get('user', '{}')
-        return json_module.loads(user_data)
+        return orjson.loads(user_data)
 
     except Exception as e:
         logger.error(f"Error verifying init_data: {e}")
         return None
 
 
+# Кэш успешных проверок админа: {init_data: (истекает (monotonic), admin_id)}
+_ADMIN_AUTH_TTL = 60  # секунд
+_ADMIN_AUTH_MAX = 1024
+_admin_auth_cache: Dict[str, Tuple[float, int]] = {}
+
+
 def verify_admin_from_header(init_data: str) -> int:
     """
     Проверка админа через X-Telegram-Init-Data заголовок.
     Возвращает user_id админа или выбрасывает HTTPException.
     """
-    from config import BOT_TOKEN
 
     if not init_data:
         raise HTTPException(status_code=401, detail="Authorization required: X-Telegram-Init-Data header missing")
 
+    # Один и тот же initData приходит со всеми запросами сессии — берём из кэша
+    now = time.monotonic()
+    cached = _admin_auth_cache.get(init_data)
+    if cached and cached[0] > now:
+        return cached[1]
+
     # Проверяем подпись
-    user = verify_telegram_init_data(init_data, BOT_TOKEN)
+    user = verify_telegram_init_data(init_data)
 
     if not user:
         raise HTTPException(status_code=401, detail="Invalid or expired init data")
@@ -1705,17 +1878,16 @@ def verify_admin_from_header(init_data: str) -> int:
     if user_id != ADMIN_ID:
         raise HTTPException(status_code=403, detail="Access denied: not admin")
 
+    if len(_admin_auth_cache) >= _ADMIN_AUTH_MAX:
+        _admin_auth_cache.clear()
+    _admin_auth_cache[init_data] = (now + _ADMIN_AUTH_TTL, user_id)
     return user_id
 
 
-from fastapi import Header, Request
-
-
 @app.get("/api/stats")
 async def webapp_admin_stats(x_telegram_init_data: str = Header(default="", alias="X-Telegram-Init-Data")):
     """Статистика для админ-панели (webapp)"""
     verify_admin_from_header(x_telegram_init_data)
-    from database.models import get_stats
     return get_stats()
 
 
@@ -1742,8 +1914,6 @@ async def webapp_geocode_search(
     """Поиск города для автокомплита"""
     verify_admin_from_header(x_telegram_init_data)
 
-    from services.geocoder import search_cities, format_coordinates
-
     try:
         geo_results = search_cities(data.city, limit=5)
         results = []
@@ -1762,159 +1932,244 @@ async def webapp_geocode_search(
         return {"results": []}
 
 
+def _webapp_user_item(user: User, sub: Optional[Subscription], now: datetime) -> dict:
+    """Строка списка пользователей админ-панели"""
+    days_left = sub.days_left_at(now) if sub else 0
+
+    return {
+        "telegram_id": user.telegram_id,
+        "username": user.username,
+        "first_name": user.first_name,
+        "birth_date": _fmt_date(user.birth_date),
+        "birth_time": _fmt_time(user.birth_time),
+        "birth_place": user.birth_place,
+        "birth_lat": user.birth_lat,
+        "birth_lon": user.birth_lon,
+        "birth_tz": user.birth_tz,
+        "residence_place": user.residence_place,
+        "natal_data_complete": user.natal_data_complete,
+        "subscription": {
+            "status": sub.status,
+            "expires_at": _fmt_date(sub.expires_at),
+            "days_left": days_left
+        } if sub else None
+    }
+
+
+def _iter_users_ndjson(query, now: datetime, chunk_size: int = 200):
+    """
+    Пользователи построчно в NDJSON, пачками по chunk_size.
+    Генератор продолжается в потоках threadpool (каждый next() — возможно, в другом потоке),
+    поэтому каждая пачка читается целиком в своём connection_context и соединение
+    возвращается в пул до yield.
+    """
+    offset = 0
+    while True:
+        with db.connection_context():
+            users = list(query.limit(chunk_size).offset(offset))
+            subs = Subscription.get_current_for_users([u.telegram_id for u in users])
+        if not users:
+            return
+        yield b"".join(
+            orjson.dumps(_webapp_user_item(user, subs.get(user.telegram_id), now)) + b"\n"
+            for user in users
+        )
+        offset += chunk_size
+
+
 @app.get("/api/users")
 async def webapp_admin_users_list(
     filter: str = Query(default="all"),
     search: str = Query(default=""),
+    format: str = Query(default="json"),  # json | ndjson
     x_telegram_init_data: str = Header(default="", alias="X-Telegram-Init-Data")
 ):
     """Список пользователей для админ-панели (webapp)"""
     verify_admin_from_header(x_telegram_init_data)
 
-    from database.models import User, Subscription
-    from datetime import datetime, timedelta
-
+    now = datetime.now()
     query = User.select()
 
-    # Фильтрация по статусу
+    # Фильтрация по статусу: условие на подписку, затем один JOIN
+    sub_cond = None
     if filter == "active":
         # Активная подписка
-        now = datetime.now()
-        active_users = (
-            Subscription.select(Subscription.user)
-            .where(
-                Subscription.status.in_(['active', 'expiring_soon']),
-                Subscription.expires_at > now
-            )
+        sub_cond = (
+            Subscription.status.in_(['active', 'expiring_soon']) &
+            (Subscription.expires_at > now)
         )
-        query = query.where(User.telegram_id.in_(active_users))
     elif filter == "expiring":
         # Истекающая в течение 7 дней
-        now = datetime.now()
-        week_later = now + timedelta(days=7)
-        expiring_users = (
-            Subscription.select(Subscription.user)
-            .where(
-                Subscription.expires_at > now,
-                Subscription.expires_at <= week_later
-            )
-        )
-        query = query.where(User.telegram_id.in_(expiring_users))
+        sub_cond = (Subscription.expires_at > now) & (Subscription.expires_at <= now + timedelta(days=7))
     elif filter == "expired":
         # Истёкшая подписка
-        now = datetime.now()
-        expired_users = (
-            Subscription.select(Subscription.user)
-            .where(Subscription.expires_at <= now)
-        )
-        query = query.where(User.telegram_id.in_(expired_users))
+        sub_cond = Subscription.expires_at <= now
     elif filter == "nodata":
         # Без натальных данных
         query = query.where(User.natal_data_complete == False)
 
-    # Поиск
+    if sub_cond is not None:
+        # JOIN вместо IN (подзапрос); group_by убирает дубли у пользователей с несколькими подписками
+        query = query.join(Subscription).where(sub_cond).group_by(User.telegram_id)
+
     if search:
-        query = query.where(
-            (User.first_name.contains(search)) |
-            (User.username.contains(search)) |
-            (User.telegram_id == int(search) if search.isdigit() else False)
-        )
+        query = query.where(_user_search_condition(search))
 
-    users_list = []
-    for user in query.order_by(User.created_at.desc()).limit(100):
-        sub = user.get_subscription()
+    # telegram_id — для стабильного порядка между пачками NDJSON
+    query = query.order_by(User.created_at.desc(), User.telegram_id)
 
-        # Вычисляем days_left
-        days_left = 0
-        if sub and sub.expires_at:
-            from datetime import datetime
-            delta = sub.expires_at - datetime.now()
-            days_left = max(0, delta.days)
+    # NDJSON: весь список без ограничения, строки уходят клиенту пачками
+    if format == "ndjson":
+        return StreamingResponse(_iter_users_ndjson(query, now), media_type="application/x-ndjson")
+
+    users = list(query.limit(100))
+
+    # Подписки всех пользователей списка одним запросом (без N+1)
+    subs = Subscription.get_current_for_users([u.telegram_id for u in users])
+
+    return {"users": [_webapp_user_item(user, subs.get(user.telegram_id), now) for user in users]}
 
-        users_list.append({
-            "telegram_id": user.telegram_id,
-            "username": user.username,
-            "first_name": user.first_name,
-            "birth_date": user.birth_date.strftime("%d.%m.%Y") if user.birth_date else None,
-            "birth_time": str(user.birth_time)[:8] if user.birth_time else None,
-            "birth_place": user.birth_place,
-            "birth_lat": user.birth_lat,
-            "birth_lon": user.birth_lon,
-            "birth_tz": user.birth_tz,
-            "residence_place": user.residence_place,
-            "natal_data_complete": user.natal_data_complete,
-            "subscription": {
-                "status": sub.status if sub else None,
-                "expires_at": sub.expires_at.strftime("%d.%m.%Y") if sub and sub.expires_at else None,
-                "days_left": days_left
-            } if sub else None
-        })
 
-    return {"users": users_list}
+class WebappSubscriptionOut(BaseModel):
+    """Подписка в карточке пользователя"""
+    model_config = {"frozen": True}
 
+    status: Optional[str] = None
+    expires_at: Optional[str] = None  # DD.MM.YYYY
+    days_left: int = 0
+    paid_via_bot: bool = True
 
-@app.get("/api/users/{user_id}")
+
+class WebappUserOut(BaseModel):
+    """Карточка пользователя для админ-панели"""
+    model_config = {"frozen": True}
+
+    telegram_id: int
+    username: Optional[str] = None
+    first_name: Optional[str] = None
+    birth_date: Optional[str] = None  # DD.MM.YYYY
+    birth_time: Optional[str] = None  # HH:MM:SS
+    birth_place: Optional[str] = None
+    birth_lat: Optional[float] = None
+    birth_lon: Optional[float] = None
+    birth_tz: Optional[str] = None
+    birth_tz_offset: Optional[float] = None
+    residence_place: Optional[str] = None
+    residence_lat: Optional[float] = None
+    residence_lon: Optional[float] = None
+    residence_tz: Optional[str] = None
+    natal_data_complete: bool = False
+    questions_today: int = 0
+    forecasts_count: int = 0
+    subscription: Optional[WebappSubscriptionOut] = None
+
+
+@app.get("/api/users/{user_id}", response_model=WebappUserOut)
 async def webapp_admin_get_user(
     user_id: int,
     x_telegram_init_data: str = Header(default="", alias="X-Telegram-Init-Data")
-):
+) -> WebappUserOut:
     """Получить детали пользователя для админ-панели"""
     verify_admin_from_header(x_telegram_init_data)
 
-    from database.models import User
-    from services.geocoder import get_timezone_offset
-
-    user = User.get_or_none(User.telegram_id == user_id)
+    # Пользователь, подписка и число прогнозов — одним запросом
+    user = User.get_with_details(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    sub = user.get_subscription()
+    sub = user.current_subscription
 
     # Вычисляем UTC offset для timezone
     birth_tz_offset = None
     if user.birth_tz:
         try:
-            from datetime import date as date_type
-            birth_tz_offset = get_timezone_offset(user.birth_tz, date_type.today())
+            birth_tz_offset = get_timezone_offset(user.birth_tz, date.today())
         except:
             pass
 
     # Вычисляем days_left
     days_left = 0
     if sub and sub.expires_at:
-        from datetime import datetime
         delta = sub.expires_at - datetime.now()
         days_left = max(0, delta.days)
 
-    # Получаем статистику
-    from database.models import Forecast
-    forecasts_count = Forecast.select().where(Forecast.user == user).count() if hasattr(user, 'forecasts') else 0
+    return WebappUserOut(
+        telegram_id=user.telegram_id,
+        username=user.username,
+        first_name=user.first_name,
+        birth_date=_fmt_date(user.birth_date),
+        birth_time=_fmt_time(user.birth_time),
+        birth_place=user.birth_place,
+        birth_lat=user.birth_lat,
+        birth_lon=user.birth_lon,
+        birth_tz=user.birth_tz,
+        birth_tz_offset=birth_tz_offset,
+        residence_place=user.residence_place,
+        residence_lat=user.residence_lat,
+        residence_lon=user.residence_lon,
+        residence_tz=user.residence_tz,
+        natal_data_complete=user.natal_data_complete,
+        questions_today=user.questions_today,
+        forecasts_count=user.forecasts_count,
+        subscription=WebappSubscriptionOut(
+            status=sub.status,
+            expires_at=_fmt_date(sub.expires_at),
+            days_left=days_left,
+            paid_via_bot=sub.paid_via_bot
+        ) if sub else None
+    )
+
+
+# Дата/время рождения из формы админки: DD.MM.YYYY и HH:MM[:SS]
+_BIRTH_DATE_RE = re.compile(r'^(\d{1,2})\.(\d{1,2})\.(\d{4})$')
+_BIRTH_TIME_RE = re.compile(r'^(\d{1,2}):(\d{1,2})(?::(\d{1,2}))?$')
+
+
+def _parse_birth_date(value: str) -> Optional[date]:
+    """DD.MM.YYYY -> date, None если формат неверный"""
+    m = _BIRTH_DATE_RE.match(value)
+    if not m:
+        return None
+    day, month, year = m.groups()
+    try:
+        return date(int(year), int(month), int(day))
+    except ValueError:  # 31.02 и т.п.
+        return None
+
+
+def _parse_birth_time(value: str) -> Optional[dt_time]:
+    """HH:MM:SS или HH:MM -> time, None если формат неверный"""
+    m = _BIRTH_TIME_RE.match(value)
+    if not m:
+        return None
+    hour, minute, second = m.groups()
+    try:
+        return dt_time(int(hour), int(minute), int(second) if second else 0)
+    except ValueError:  # 25:00 и т.п.
+        return None
 
-    return {
-        "telegram_id": user.telegram_id,
-        "username": user.username,
-        "first_name": user.first_name,
-        "birth_date": user.birth_date.strftime("%d.%m.%Y") if user.birth_date else None,
-        "birth_time": str(user.birth_time)[:8] if user.birth_time else None,
-        "birth_place": user.birth_place,
-        "birth_lat": user.birth_lat,
-        "birth_lon": user.birth_lon,
-        "birth_tz": user.birth_tz,
-        "birth_tz_offset": birth_tz_offset,
-        "residence_place": user.residence_place,
-        "residence_lat": user.residence_lat,
-        "residence_lon": user.residence_lon,
-        "residence_tz": user.residence_tz,
-        "natal_data_complete": user.natal_data_complete,
-        "questions_today": user.questions_today,
-        "forecasts_count": forecasts_count,
-        "subscription": {
-            "status": sub.status if sub else None,
-            "expires_at": sub.expires_at.strftime("%d.%m.%Y") if sub and sub.expires_at else None,
-            "days_left": days_left,
-            "paid_via_bot": sub.paid_via_bot if sub and hasattr(sub, 'paid_via_bot') else True
-        } if sub else None
-    }
+
+# Поля, изменение которых сбрасывает кэш календаря пользователя
+NATAL_FIELDS = frozenset({
+    'birth_date', 'birth_time', 'birth_lat', 'birth_lon', 'birth_tz',
+    'residence_lat', 'residence_lon', 'residence_tz',
+})
+
+# Поля, без которых натальные данные неполные (как в User.has_natal_data)
+NATAL_REQUIRED_FIELDS = ('birth_date', 'birth_time', 'birth_place', 'birth_lat', 'birth_lon')
+
+# Строковые поля формы, которые нужно разобрать перед записью
+BIRTH_PARSERS = {
+    'birth_date': _parse_birth_date,
+    'birth_time': _parse_birth_time,
+}
+
+# Колонки User, которые можно менять из формы webapp
+WEBAPP_EDITABLE_FIELDS = (
+    'first_name',
+    'birth_date', 'birth_time', 'birth_place', 'birth_lat', 'birth_lon', 'birth_tz',
+    'residence_place', 'residence_lat', 'residence_lon', 'residence_tz',
+)
 
 
 class WebappUserUpdate(BaseModel):
@@ -1933,174 +2188,132 @@ class WebappUserUpdate(BaseModel):
     residence_tz: Optional[str] = None
 
 
+def _user_exists(telegram_id: int) -> bool:
+    """Проверка существования пользователя по ключу, без загрузки строки"""
+    return User.select(User.telegram_id).where(User.telegram_id == telegram_id).exists()
+
+
+@db.connection_context()
+def _invalidate_calendar_cache(user_id: int) -> None:
+    """Фоновый сброс кэша календаря (число удалённых записей логирует сама модель)"""
+    CalendarCache.invalidate_for_user(user_id)
+
+
+# Изменяющие обработчики ниже — обычные def: FastAPI выполняет их в пуле потоков,
+# и синхронные запросы Peewee (у каждого потока своё соединение) не блокируют event loop.
+# db.connection_context() берёт соединение из пула на время запроса и возвращает его
+# в том же потоке, где выполнялся обработчик
+
 @app.patch("/api/users/{user_id}")
-async def webapp_admin_update_user(
+@db.connection_context()
+def webapp_admin_update_user(
     user_id: int,
     data: WebappUserUpdate,
+    background_tasks: BackgroundTasks,
     x_telegram_init_data: str = Header(default="", alias="X-Telegram-Init-Data")
 ):
     """Обновить данные пользователя"""
     verify_admin_from_header(x_telegram_init_data)
 
-    from database.models import User, CalendarCache
-    from datetime import datetime
+    # Только переданные поля; None, как и раньше, означает «не менять»
+    changed = {
+        field: value
+        for field, value in data.model_dump(exclude_unset=True).items()
+        if value is not None and field != 'telegram_id'
+    }
 
-    user = User.get_or_none(User.telegram_id == user_id)
-    if not user:
+    for field, parse in BIRTH_PARSERS.items():
+        if field in changed:
+            changed[field] = parse(changed[field])
+            if changed[field] is None:
+                raise HTTPException(status_code=400, detail=f"Invalid {field} format")
+
+    # Текущие значения редактируемых колонок — один лёгкий SELECT без загрузки модели
+    current = User.select(
+        *[getattr(User, field) for field in WEBAPP_EDITABLE_FIELDS], User.natal_data_complete
+    ).where(User.telegram_id == user_id).dicts().first()
+    if current is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    # Отслеживаем изменение натальных данных для инвалидации кэша
-    natal_data_changed = False
-
-    # Обновляем поля
-    if data.first_name is not None:
-        user.first_name = data.first_name
+    # Повторная отправка той же формы ничего не меняет: отбрасываем совпадающие значения,
+    # чтобы не переписывать строку и не сбрасывать кэш календаря зря
+    changed = {field: value for field, value in changed.items() if current[field] != value}
+    current.update(changed)
 
-    if data.birth_date is not None:
-        try:
-            user.birth_date = datetime.strptime(data.birth_date, "%d.%m.%Y").date()
-            natal_data_changed = True
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid birth_date format")
+    # Проверяем полноту данных по уже объединённым значениям и пишем флаг тем же UPDATE.
+    # Выражение в самом SET не подходит: SQLite вычисляет его по старой строке
+    if not current['natal_data_complete'] and all(current[field] for field in NATAL_REQUIRED_FIELDS):
+        changed['natal_data_complete'] = True
 
-    if data.birth_time is not None:
-        try:
-            user.birth_time = datetime.strptime(data.birth_time, "%H:%M:%S").time()
-            natal_data_changed = True
-        except ValueError:
-            try:
-                user.birth_time = datetime.strptime(data.birth_time, "%H:%M").time()
-                natal_data_changed = True
-            except ValueError:
-                raise HTTPException(status_code=400, detail="Invalid birth_time format")
-
-    if data.birth_place is not None:
-        user.birth_place = data.birth_place
-    if data.birth_lat is not None:
-        user.birth_lat = data.birth_lat
-        natal_data_changed = True
-    if data.birth_lon is not None:
-        user.birth_lon = data.birth_lon
-        natal_data_changed = True
-    if data.birth_tz is not None:
-        user.birth_tz = data.birth_tz
-        natal_data_changed = True
-
-    if data.residence_place is not None:
-        user.residence_place = data.residence_place
-    if data.residence_lat is not None:
-        user.residence_lat = data.residence_lat
-        natal_data_changed = True
-    if data.residence_lon is not None:
-        user.residence_lon = data.residence_lon
-        natal_data_changed = True
-    if data.residence_tz is not None:
-        user.residence_tz = data.residence_tz
-        natal_data_changed = True
-
-    # Проверяем полноту данных
-    if user.has_natal_data():
-        user.natal_data_complete = True
+    if not changed:
+        return {"status": "ok"}
 
-    user.save()
+    # Один UPDATE только изменённых колонок
+    changed['updated_at'] = datetime.now()
+    User.update(changed).where(User.telegram_id == user_id).execute()
 
-    # Инвалидируем кэш календаря при изменении натальных данных
-    if natal_data_changed:
-        deleted_cache = CalendarCache.invalidate_for_user(user_id)
-        logger.info(f"Натальные данные изменены для user {user_id}, кэш инвалидирован ({deleted_cache} записей)")
-        return {"status": "ok", "cache_invalidated": deleted_cache}
+    # Кэш календаря при изменении натальных данных сбрасываем уже после ответа
+    if not NATAL_FIELDS.isdisjoint(changed):
+        background_tasks.add_task(_invalidate_calendar_cache, user_id)
+        return {"status": "ok", "cache_invalidation": "scheduled"}
 
     return {"status": "ok"}
 
 
 @app.post("/api/users")
-async def webapp_admin_create_user(
+@db.connection_context()
+def webapp_admin_create_user(
     data: WebappUserUpdate,
     x_telegram_init_data: str = Header(default="", alias="X-Telegram-Init-Data")
 ):
     """Создать нового пользователя"""
     verify_admin_from_header(x_telegram_init_data)
 
-    from database.models import User
-    from datetime import datetime
-
     if not data.telegram_id:
         raise HTTPException(status_code=400, detail="telegram_id is required")
 
     # Проверяем что пользователь не существует
-    existing = User.get_or_none(User.telegram_id == data.telegram_id)
-    if existing:
+    if _user_exists(data.telegram_id):
         raise HTTPException(status_code=409, detail="User already exists")
 
-    # Создаём пользователя
+    # Заполненные поля формы; неверный формат даты/времени при создании просто пропускаем
+    fields = {}
+    for field, value in data.model_dump(exclude={'telegram_id', 'first_name'}).items():
+        if value:
+            parse = BIRTH_PARSERS.get(field)
+            fields[field] = parse(value) if parse else value
+
+    # Проверяем полноту данных
+    fields['natal_data_complete'] = all(fields.get(field) for field in NATAL_REQUIRED_FIELDS)
+
+    # Создаём пользователя сразу со всеми данными — один INSERT
     user = User.create(
         telegram_id=data.telegram_id,
         first_name=data.first_name or "User",
-        username=None
+        username=None,
+        **fields
     )
 
-    # Устанавливаем данные
-    if data.birth_date:
-        try:
-            user.birth_date = datetime.strptime(data.birth_date, "%d.%m.%Y").date()
-        except ValueError:
-            pass
-
-    if data.birth_time:
-        try:
-            user.birth_time = datetime.strptime(data.birth_time, "%H:%M:%S").time()
-        except ValueError:
-            try:
-                user.birth_time = datetime.strptime(data.birth_time, "%H:%M").time()
-            except ValueError:
-                pass
-
-    if data.birth_place:
-        user.birth_place = data.birth_place
-    if data.birth_lat:
-        user.birth_lat = data.birth_lat
-    if data.birth_lon:
-        user.birth_lon = data.birth_lon
-    if data.birth_tz:
-        user.birth_tz = data.birth_tz
-
-    if data.residence_place:
-        user.residence_place = data.residence_place
-    if data.residence_lat:
-        user.residence_lat = data.residence_lat
-    if data.residence_lon:
-        user.residence_lon = data.residence_lon
-    if data.residence_tz:
-        user.residence_tz = data.residence_tz
-
-    # Проверяем полноту данных
-    if user.has_natal_data():
-        user.natal_data_complete = True
-
-    user.save()
-
     return {"status": "ok", "telegram_id": user.telegram_id}
 
 
 @app.delete("/api/users/{user_id}")
-async def webapp_admin_delete_user(
+@db.connection_context()
+def webapp_admin_delete_user(
     user_id: int,
     x_telegram_init_data: str = Header(default="", alias="X-Telegram-Init-Data")
 ):
     """Удалить пользователя"""
     verify_admin_from_header(x_telegram_init_data)
 
-    from database.models import User, Subscription
-
-    user = User.get_or_none(User.telegram_id == user_id)
-    if not user:
+    # Удаляем по ключу, не загружая строку пользователя
+    if not _user_exists(user_id):
         raise HTTPException(status_code=404, detail="User not found")
 
-    # Удаляем связанные подписки
-    Subscription.delete().where(Subscription.user == user).execute()
-
-    # Удаляем пользователя
-    user.delete_instance()
+    # Подписки и пользователь — одной транзакцией (один коммит)
+    with db.atomic():
+        Subscription.delete().where(Subscription.user == user_id).execute()
+        User.delete().where(User.telegram_id == user_id).execute()
 
     return {"status": "ok"}
 
@@ -2112,7 +2325,8 @@ class WebappSubscriptionAction(BaseModel):
 
 
 @app.post("/api/users/{user_id}/subscription")
-async def webapp_admin_subscription(
+@db.connection_context()
+def webapp_admin_subscription(
     user_id: int,
     data: WebappSubscriptionAction,
     x_telegram_init_data: str = Header(default="", alias="X-Telegram-Init-Data")
@@ -2120,27 +2334,19 @@ async def webapp_admin_subscription(
     """Управление подпиской пользователя"""
     verify_admin_from_header(x_telegram_init_data)
 
-    from database.models import User, Subscription
-
-    user = User.get_or_none(User.telegram_id == user_id)
-    if not user:
+    if not _user_exists(user_id):
         raise HTTPException(status_code=404, detail="User not found")
 
     if data.action == "extend":
-        # Получаем или создаём подписку
-        sub = user.get_subscription()
-        if not sub:
-            sub = Subscription.create_for_user(user)
-
-        # Продлеваем
-        sub.activate(days=data.days)
+        # Продлеваем текущую подписку или сразу выдаём новую
+        expires_at = Subscription.extend_for_user(user_id, days=data.days)
 
         return {
             "status": "ok",
-            "expires_at": sub.expires_at.strftime("%d.%m.%Y")
+            "expires_at": _fmt_date(expires_at)
         }
     elif data.action == "cancel":
-        sub = user.get_subscription()
+        sub = Subscription.get_current(user_id)
         if sub:
             sub.cancel()
         return {"status": "ok"}
@@ -3,15 +3,21 @@
 
 """
 Конфигурация Астро-бота
+
+Переменные окружения читаются один раз при импорте — в коде используйте
+константы этого модуля, а не os.getenv()
 """
 
 import os
 from pathlib import Path
 from dotenv import load_dotenv
 
-# Загружаем .env
+# Загружаем .env. Дочерние процессы (воркеры) наследуют уже заполненное окружение —
+# повторно файл не читаем и не разбираем
 BASE_DIR = Path(__file__).parent.parent
-load_dotenv(BASE_DIR / ".env")
+if not os.environ.get("_ASTRO_ENV_LOADED"):
+    load_dotenv(BASE_DIR / ".env")
+    os.environ["_ASTRO_ENV_LOADED"] = "1"
 
 # Telegram
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -30,6 +36,8 @@ YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY", "")
 
 # База данных
 DB_PATH = os.getenv("DB_PATH", str(BASE_DIR / "astro_bot.sqlite"))
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", 32))  # размер пула соединений
+DB_STALE_TIMEOUT = int(os.getenv("DB_STALE_TIMEOUT", 300))  # секунд до пересоздания соединения
 
 # Подписка
 SUBSCRIPTION_PRICE = int(os.getenv("SUBSCRIPTION_PRICE", 1990))
@@ -77,6 +85,9 @@ BOT_RETURN_URL = f"https://t.me/{BOT_USERNAME}"
 # Mini App URL (для локальной разработки — localhost, для прода — публичный URL)
 WEBAPP_URL = os.getenv("WEBAPP_URL", "https://your-domain.com")
 
+# Режим разработки админки: проверка Telegram-авторизации отключена
+DEV_MODE = os.getenv("DEV_MODE") == "1"
+
 # Юридические документы
 DOCS_OFFER = "https://disk.yandex.ru/d/CTe2fBbWrwolfg"  # Договор-оферта
 DOCS_PD_CONSENT = "https://disk.yandex.ru/i/J8_SAQJ9b5Ewcg"  # Согласие на обработку ПД
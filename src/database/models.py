@@ -10,27 +10,44 @@ from datetime import datetime, date, timedelta
 from decimal import Decimal
 from typing import Optional, List, Dict
 
+import orjson
 from peewee import (
-    SqliteDatabase, Model,
+    Model,
     BigIntegerField, CharField, TextField,
     DateField, TimeField, DateTimeField,
     FloatField, BooleanField, IntegerField, DecimalField,
-    ForeignKeyField
+    ForeignKeyField, Case, EXCLUDED, JOIN, fn
 )
+from playhouse.pool import PooledSqliteDatabase
 
-from config import DB_PATH, SUBSCRIPTION_DAYS
+from config import DB_PATH, DB_MAX_CONNECTIONS, DB_STALE_TIMEOUT, SUBSCRIPTION_DAYS
 
 logger = logging.getLogger(__name__)
 
 # Инициализация БД
-db = SqliteDatabase(DB_PATH, pragmas={
-    'journal_mode': 'wal',
-    'cache_size': -1 * 64000,
-    'foreign_keys': 1,
-    'ignore_check_constraints': 0,
-    'synchronous': 1,  # NORMAL — баланс между производительностью и безопасностью
-    'busy_timeout': 5000  # 5 секунд ожидания при блокировке БД
-})
+# Пул соединений: закрытое соединение (db.close()) возвращается в пул, а не закрывается.
+# Если пул исчерпан, ждём освобождения до timeout секунд.
+# Соединение привязано к потоку: код, работающий с БД в потоках пула (to_thread, sync-эндпоинты,
+# задачи планировщика), должен идти через db.connection_context(), иначе соединение не вернётся в пул
+db = PooledSqliteDatabase(
+    DB_PATH,
+    max_connections=DB_MAX_CONNECTIONS,
+    stale_timeout=DB_STALE_TIMEOUT,
+    timeout=30,
+    check_same_thread=False,
+    pragmas={
+        'page_size': 8192,  # действует только для новой БД — до включения WAL и первой записи
+        'journal_mode': 'wal',
+        'cache_size': -1 * 64000,
+        'foreign_keys': 1,
+        'ignore_check_constraints': 0,
+        'synchronous': 1,  # NORMAL — баланс между производительностью и безопасностью
+        'busy_timeout': 5000,  # 5 секунд ожидания при блокировке БД
+        'mmap_size': 256 * 1024 * 1024,  # чтение страниц через mmap вместо read()
+        'temp_store': 'memory',  # временные таблицы/сортировки в памяти
+        'wal_autocheckpoint': 1000  # checkpoint WAL каждые ~1000 страниц
+    }
+)
 
 
 class BaseModel(Model):
@@ -125,43 +142,79 @@ class User(BaseModel):
 
     def get_subscription(self) -> Optional['Subscription']:
         """Получить текущую подписку"""
-        return Subscription.select().where(
-            Subscription.user == self,
-            Subscription.status.in_(['active', 'expiring_soon'])
-        ).order_by(Subscription.expires_at.desc()).first()
+        return Subscription.get_current(self.telegram_id)
+
+    @classmethod
+    def get_with_details(cls, telegram_id: int) -> Optional['User']:
+        """
+        Пользователь вместе с текущей подпиской и числом прогнозов — одним запросом.
+        Подписка (как в get_subscription()) — в user.current_subscription (или None),
+        число прогнозов — в user.forecasts_count.
+        """
+        latest = Subscription.alias()
+        current_sub_id = latest.select(latest.id).where(
+            latest.user == cls.telegram_id,
+            latest.status.in_(['active', 'expiring_soon'])
+        ).order_by(latest.expires_at.desc()).limit(1)
+        forecasts_count = Forecast.select(fn.COUNT(Forecast.id)).where(
+            Forecast.user == cls.telegram_id
+        )
+
+        return cls.select(
+            cls, Subscription, forecasts_count.alias('forecasts_count')
+        ).join(
+            Subscription, JOIN.LEFT_OUTER,
+            on=(Subscription.id == current_sub_id), attr='current_subscription'
+        ).where(cls.telegram_id == telegram_id).first()
 
     def has_active_subscription(self) -> bool:
         """Есть ли активная подписка (оплачена и срок не истёк)"""
-        sub = self.get_subscription()
-        if not sub:
-            return False
-        # Проверяем: статус активен, срок не истёк, И есть payment_id (оплачена)
-        return (
-            sub.status in ['active', 'expiring_soon'] and
-            sub.expires_at > datetime.now() and
-            sub.payment_id is not None
-        )
+        # Статус активен, срок не истёк, И есть payment_id (оплачена) — всё в WHERE,
+        # SELECT EXISTS останавливается на первой подходящей строке
+        return Subscription.select(Subscription.id).where(
+            (Subscription.user == self.telegram_id) &
+            Subscription.status.in_(['active', 'expiring_soon']) &
+            (Subscription.expires_at > datetime.now()) &
+            Subscription.payment_id.is_null(False)
+        ).exists()
+
+    def _reset_questions_if_stale(self) -> None:
+        """Сброс счётчика вопросов в новый день — UPDATE двух колонок вместо save() всей строки"""
+        today = date.today()
+        if self.questions_reset_date == today:
+            return
+
+        User.update(questions_today=0, questions_reset_date=today).where(
+            (User.telegram_id == self.telegram_id) &
+            (User.questions_reset_date.is_null() | (User.questions_reset_date != today))
+        ).execute()
+        self.questions_today = 0
+        self.questions_reset_date = today
 
     def get_questions_remaining(self) -> int:
         """Сколько вопросов осталось сегодня"""
         from config import QUESTIONS_PER_DAY
 
         # Сброс счётчика если новый день
-        today = date.today()
-        if self.questions_reset_date != today:
-            self.questions_today = 0
-            self.questions_reset_date = today
-            self.save()
+        self._reset_questions_if_stale()
 
         return max(0, QUESTIONS_PER_DAY - self.questions_today)
 
     def use_question(self) -> bool:
         """Использовать один вопрос. Возвращает True если успешно"""
-        if self.get_questions_remaining() <= 0:
+        from config import QUESTIONS_PER_DAY
+
+        self._reset_questions_if_stale()
+
+        # Атомарный инкремент в БД: без read-modify-write и гонки между запросами
+        updated = User.update(questions_today=User.questions_today + 1).where(
+            (User.telegram_id == self.telegram_id) &
+            (User.questions_today < QUESTIONS_PER_DAY)
+        ).execute()
+        if not updated:
             return False
 
         self.questions_today += 1
-        self.save()
         return True
 
 
@@ -188,10 +241,13 @@ class Subscription(BaseModel):
     @property
     def days_left(self) -> int:
         """Дней до окончания"""
+        return self.days_left_at(datetime.now())
+
+    def days_left_at(self, now: datetime) -> int:
+        """Дней до окончания на момент now — для списков, где now вычислен один раз"""
         if not self.expires_at:
             return 0
-        delta = self.expires_at - datetime.now()
-        return max(0, delta.days)
+        return max(0, (self.expires_at - now).days)
 
     @property
     def is_expiring_soon(self) -> bool:
@@ -218,11 +274,81 @@ class Subscription(BaseModel):
 
         self.save()
 
+    @classmethod
+    def extend_for_user(cls, user_id: int, days: int = None) -> datetime:
+        """
+        Продлить текущую подписку пользователя (как activate()) или выдать новую.
+        Пишутся только изменённые колонки; без подписки — один INSERT сразу активной.
+
+        Returns:
+            Новая дата окончания
+        """
+        days = days or SUBSCRIPTION_DAYS
+        now = datetime.now()
+
+        with db.atomic():
+            sub = cls.get_current(user_id)
+            if sub is None:
+                expires_at = now + timedelta(days=days)
+                cls.create(
+                    user=user_id,
+                    status="active",
+                    started_at=now,
+                    expires_at=expires_at,
+                    payment_id="admin_granted"
+                )
+                return expires_at
+
+            # Если подписка ещё идёт — продлеваем от её конца
+            if sub.expires_at and sub.expires_at > now:
+                expires_at = sub.expires_at + timedelta(days=days)
+                fields = {cls.expires_at: expires_at, cls.status: "active"}
+            else:
+                expires_at = now + timedelta(days=days)
+                fields = {cls.started_at: now, cls.expires_at: expires_at, cls.status: "active"}
+
+            # Без payment_id — значит назначение админом
+            if not sub.payment_id:
+                fields[cls.payment_id] = "admin_granted"
+
+            cls.update(fields).where(cls.id == sub.id).execute()
+        return expires_at
+
     def cancel(self):
         """Отменить подписку"""
         self.status = "expired"
         self.save()
 
+    @classmethod
+    def get_current(cls, user_id: int) -> Optional['Subscription']:
+        """Текущая подписка по telegram_id — без загрузки самого пользователя"""
+        return cls.select().where(
+            cls.user == user_id,
+            cls.status.in_(['active', 'expiring_soon'])
+        ).order_by(cls.expires_at.desc()).first()
+
+    @classmethod
+    def get_current_for_users(cls, user_ids: List[int]) -> Dict[int, 'Subscription']:
+        """
+        Текущие подписки для набора пользователей одним запросом.
+        Аналог User.get_subscription() для списков (без N+1).
+
+        Returns:
+            Словарь {telegram_id: Subscription}
+        """
+        if not user_ids:
+            return {}
+
+        subs = {}
+        query = cls.select().where(
+            cls.user.in_(user_ids),
+            cls.status.in_(['active', 'expiring_soon'])
+        ).order_by(cls.expires_at.desc())
+        for sub in query:
+            # Первая по expires_at DESC — самая поздняя, как в get_subscription()
+            subs.setdefault(sub.user_id, sub)
+        return subs
+
     @classmethod
     def create_for_user(cls, user: User, amount: Decimal = None, payment_id: str = None) -> 'Subscription':
         """Создать новую подписку для пользователя"""
@@ -272,16 +398,14 @@ class Conversation(BaseModel):
 
     def get_messages(self) -> List[Dict]:
         """Получить сообщения как список словарей"""
-        import json
         try:
-            return json.loads(self.messages)
-        except (json.JSONDecodeError, TypeError):
+            return orjson.loads(self.messages)
+        except (orjson.JSONDecodeError, TypeError):
             return []
 
     def set_messages(self, messages: List[Dict]):
         """Установить сообщения из списка словарей"""
-        import json
-        self.messages = json.dumps(messages, ensure_ascii=False)
+        self.messages = orjson.dumps(messages).decode()
 
 
 class CalendarCache(BaseModel):
@@ -300,20 +424,19 @@ class CalendarCache(BaseModel):
         table_name = 'calendar_cache'
         indexes = (
             (('user', 'year', 'month'), True),  # Уникальный индекс
+            (('expires_at',), False),  # cleanup_expired: DELETE WHERE expires_at < now
         )
 
     def get_days(self) -> List[Dict]:
         """Получить данные дней как список"""
-        import json
         try:
-            return json.loads(self.days_data)
-        except (json.JSONDecodeError, TypeError):
+            return orjson.loads(self.days_data)
+        except (orjson.JSONDecodeError, TypeError):
             return []
 
     def set_days(self, days: List[Dict]):
         """Сохранить данные дней"""
-        import json
-        self.days_data = json.dumps(days, ensure_ascii=False)
+        self.days_data = orjson.dumps(days).decode()
 
     def is_valid(self) -> bool:
         """Проверить, не истёк ли кэш"""
@@ -334,21 +457,21 @@ class CalendarCache(BaseModel):
     @classmethod
     def save_cache(cls, user_id: int, year: int, month: int, days: List[Dict], ttl_days: int = 30) -> 'CalendarCache':
         """Сохранить или обновить кэш календаря"""
-        import json
         expires = datetime.now() + timedelta(days=ttl_days)
+        days_data = orjson.dumps(days).decode()  # UTF-8 как есть, аналог ensure_ascii=False
 
         cache, created = cls.get_or_create(
             user_id=user_id,
             year=year,
             month=month,
             defaults={
-                'days_data': json.dumps(days, ensure_ascii=False),
+                'days_data': days_data,
                 'expires_at': expires
             }
         )
 
         if not created:
-            cache.days_data = json.dumps(days, ensure_ascii=False)
+            cache.days_data = days_data
             cache.expires_at = expires
             cache.save()
 
@@ -397,10 +520,32 @@ class SupportTicket(BaseModel):
         self.updated_at = datetime.now()
         return super().save(*args, **kwargs)
 
+    @classmethod
+    def with_last_messages(cls, query) -> List['SupportTicket']:
+        """
+        Выполнить запрос тикетов и подгрузить последнее сообщение каждого одним запросом
+        (иначе last_message_preview делает отдельный SELECT на каждый тикет).
+        """
+        tickets = list(query)
+        if not tickets:
+            return tickets
+
+        last_ids = SupportMessage.select(fn.MAX(SupportMessage.id)).where(
+            SupportMessage.ticket.in_([ticket.id for ticket in tickets])
+        ).group_by(SupportMessage.ticket)
+        last = {msg.ticket_id: msg for msg in SupportMessage.select().where(SupportMessage.id.in_(last_ids))}
+
+        for ticket in tickets:
+            ticket._last_message = last.get(ticket.id)
+        return tickets
+
     @property
     def last_message_preview(self) -> str:
         """Превью последнего сообщения"""
-        msg = self.messages.order_by(SupportMessage.created_at.desc()).first()
+        if hasattr(self, '_last_message'):
+            msg = self._last_message  # подгружено в with_last_messages()
+        else:
+            msg = self.messages.order_by(SupportMessage.created_at.desc()).first()
         if msg:
             return msg.message_text[:50] + "..." if len(msg.message_text) > 50 else msg.message_text
         return ""
@@ -500,6 +645,38 @@ def run_migrations():
     else:
         logger.info("Миграции не требуются, все поля существуют")
 
+    # Индексы для поиска пользователей по началу имени/username (LIKE 'x%')
+    db.execute_sql("CREATE INDEX IF NOT EXISTS idx_user_first_name ON users(first_name COLLATE NOCASE)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS idx_user_username ON users(username COLLATE NOCASE)")
+
+    # Очистка устаревшего кэша календаря (для БД, созданных до индекса в CalendarCache.Meta)
+    db.execute_sql("CREATE INDEX IF NOT EXISTS calendarcache_expires_at ON calendar_cache(expires_at)")
+
+    # Одна фаза каждого типа в день (нужен для ON CONFLICT в предрасчёте фаз).
+    # В существующих БД могли накопиться дубликаты — сначала убираем их, оставляя самую раннюю запись
+    has_phase_index = db.execute_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'moonphase_phase_type_phase_date'"
+    ).fetchone()
+    if not has_phase_index:
+        with db.atomic():
+            cursor = db.execute_sql(
+                "DELETE FROM moon_phases WHERE id NOT IN ("
+                "SELECT MIN(id) FROM moon_phases GROUP BY phase_type, phase_date)"
+            )
+            if cursor.rowcount:
+                logger.info(f"Удалено дубликатов лунных фаз: {cursor.rowcount}")
+            db.execute_sql(
+                "CREATE UNIQUE INDEX moonphase_phase_type_phase_date "
+                "ON moon_phases(phase_type, phase_date)"
+            )
+
+    # Текущая подписка пользователя: user_id = ? AND status IN (...) ORDER BY expires_at DESC.
+    # Имя совпадает с add_subscription_indexes.py, чтобы не создать дубликат
+    db.execute_sql(
+        "CREATE INDEX IF NOT EXISTS idx_sub_user_status_expires "
+        "ON subscriptions(user_id, status, expires_at)"
+    )
+
 
 # ============== ИНИЦИАЛИЗАЦИЯ ==============
 
@@ -517,6 +694,8 @@ def init_db():
         MoonPhase,
         Eclipse
     ], safe=True)
+    # Обновить статистику планировщика запросов (дёшево: анализирует только то, что нужно)
+    db.execute_sql('PRAGMA optimize')
     logger.info("База данных инициализирована")
 
     # Запускаем миграции
@@ -532,72 +711,69 @@ def get_or_create_user(
     first_name: str = None
 ) -> tuple[User, bool]:
     """Получить или создать пользователя"""
-    user, created = User.get_or_create(
-        telegram_id=telegram_id,
-        defaults={
-            'username': username,
-            'first_name': first_name or ""
-        }
-    )
+    now = datetime.now()
 
-    # Обновляем данные если пользователь уже существует
-    if not created:
-        updated = False
-        if username and user.username != username:
-            user.username = username
-            updated = True
-        if first_name and user.first_name != first_name:
-            user.first_name = first_name
-            updated = True
-        if updated:
-            user.save()
+    # Пустые username/first_name, как и раньше, не затирают сохранённые значения
+    new_username = fn.NULLIF(EXCLUDED.username, '')
+    new_first_name = fn.NULLIF(EXCLUDED.first_name, '')
+
+    # Один INSERT ... ON CONFLICT DO UPDATE вместо SELECT + INSERT/UPDATE;
+    # существующая строка перезаписывается, только если имя действительно изменилось
+    User.insert(
+        telegram_id=telegram_id,
+        username=username,
+        first_name=first_name or "",
+        created_at=now,
+        updated_at=now
+    ).on_conflict(
+        conflict_target=[User.telegram_id],
+        update={
+            User.username: fn.COALESCE(new_username, User.username),
+            User.first_name: fn.COALESCE(new_first_name, User.first_name),
+            User.updated_at: now
+        },
+        where=(
+            (new_username.is_null(False) & (User.username.is_null() | (User.username != new_username))) |
+            (new_first_name.is_null(False) & (User.first_name != new_first_name))
+        )
+    ).execute()
 
-    return user, created
+    user = User.get_by_id(telegram_id)
+    # created_at ставится только при вставке — по нему и определяем, что строка новая
+    return user, user.created_at == now
 
 
 def get_stats() -> dict:
     """Получить статистику для админ-панели"""
-    from datetime import timedelta
-
-    today = date.today()
-    three_days = datetime.now() + timedelta(days=3)
-
-    total_users = User.select().count()
-    with_data = User.select().where(User.natal_data_complete == True).count()
+    now = datetime.now()
+    three_days = now + timedelta(days=3)
+
+    # Пользователи — один проход по таблице
+    users = User.select(
+        fn.COUNT(User.telegram_id).alias('total'),
+        fn.SUM(Case(None, [(User.natal_data_complete == True, 1)], 0)).alias('with_data')
+    ).dicts().get()
+    total_users = users['total']
+    with_data = users['with_data'] or 0
     without_data = total_users - with_data
 
-    # Подписки
-    active_subs = Subscription.select().where(
-        Subscription.status.in_(['active', 'expiring_soon']),
-        Subscription.expires_at > datetime.now()
-    ).count()
-
-    expiring_soon = Subscription.select().where(
-        Subscription.status.in_(['active', 'expiring_soon']),
-        Subscription.expires_at <= three_days,
-        Subscription.expires_at > datetime.now()
-    ).count()
-
-    expired = Subscription.select().where(
-        Subscription.status == 'expired'
-    ).count()
-
-    # Финансы — сумма всех оплат
-    from peewee import fn
-    total_revenue = Subscription.select(
-        fn.COALESCE(fn.SUM(Subscription.amount), 0)
-    ).where(
-        Subscription.amount.is_null(False)
-    ).scalar() or 0
+    # Подписки и финансы (сумма всех оплат) — тоже один агрегирующий запрос
+    is_current = Subscription.status.in_(['active', 'expiring_soon']) & (Subscription.expires_at > now)
+    subs = Subscription.select(
+        fn.SUM(Case(None, [(is_current, 1)], 0)).alias('active'),
+        fn.SUM(Case(None, [(is_current & (Subscription.expires_at <= three_days), 1)], 0)).alias('expiring'),
+        fn.SUM(Case(None, [(Subscription.status == 'expired', 1)], 0)).alias('expired'),
+        fn.COALESCE(fn.SUM(Subscription.amount), 0).alias('revenue')
+    ).dicts().get()
 
     return {
         'total_users': total_users,
         'with_data': with_data,
         'without_data': without_data,
-        'active_subs': active_subs,
-        'expiring_soon': expiring_soon,
-        'expired': expired,
-        'total_revenue': total_revenue
+        'active_subs': subs['active'] or 0,
+        'expiring_soon': subs['expiring'] or 0,
+        'expired': subs['expired'] or 0,
+        'total_revenue': subs['revenue'] or 0
     }
 
 
@@ -657,18 +833,12 @@ def precalculate_moon_phases_if_needed():
         # Следующая фаза через 14 дней
         current_dt = phase_dt + timedelta(days=14)
 
-    # Удаляем дубликаты и сортируем
-    seen = set()
-    unique_phases = []
-    for phase in sorted(phases_to_create, key=lambda x: x['phase_datetime']):
-        key = (phase['phase_type'], phase['phase_date'])
-        if key not in seen:
-            seen.add(key)
-            unique_phases.append(phase)
-
-    # Массовая вставка
-    if unique_phases:
-        MoonPhase.insert_many(unique_phases).execute()
-        logger.info(f"Precalculated {len(unique_phases)} moon phases")
+    # Массовая вставка одной транзакцией; дубликаты (phase_type, phase_date)
+    # отбрасывает уникальный индекс (ON CONFLICT DO NOTHING).
+    # IMMEDIATE — блокировка записи сразу, без SQLITE_BUSY посреди транзакции
+    if phases_to_create:
+        with db.atomic('IMMEDIATE'):
+            inserted = MoonPhase.insert_many(phases_to_create).on_conflict_ignore().as_rowcount().execute()
+        logger.info(f"Precalculated {inserted} moon phases")
     else:
         logger.warning("No moon phases to precalculate")
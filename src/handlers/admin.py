@@ -704,7 +704,7 @@ async def admin_callback(client: Client, callback: CallbackQuery):
     # === ПОДДЕРЖКА ===
 
     elif data == "adm_support":
-        tickets = list(SupportTicket.select().where(
+        tickets = SupportTicket.with_last_messages(SupportTicket.select(SupportTicket, User).join(User).where(
             SupportTicket.status == "open"
         ).order_by(SupportTicket.updated_at.desc()))
         await callback.answer()
@@ -717,7 +717,7 @@ async def admin_callback(client: Client, callback: CallbackQuery):
         filter_type = data.replace("adm_support_", "")
         status_map = {"new": "open", "progress": "answered", "closed": "closed"}
         status = status_map.get(filter_type, "open")
-        tickets = list(SupportTicket.select().where(
+        tickets = SupportTicket.with_last_messages(SupportTicket.select(SupportTicket, User).join(User).where(
             SupportTicket.status == status
         ).order_by(SupportTicket.updated_at.desc()))
         await callback.answer()
@@ -761,7 +761,7 @@ async def admin_callback(client: Client, callback: CallbackQuery):
             ticket.save()
             await callback.answer("Тикет закрыт")
             # Возврат к списку
-            tickets = list(SupportTicket.select().where(
+            tickets = SupportTicket.with_last_messages(SupportTicket.select(SupportTicket, User).join(User).where(
                 SupportTicket.status == "open"
             ).order_by(SupportTicket.updated_at.desc()))
             await callback.message.edit_text(
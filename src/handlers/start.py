@@ -605,11 +605,12 @@ async def callback_handler(client: Client, callback: CallbackQuery):
     elif data == "support_list":
         await callback.answer()
         # Получаем тикеты пользователя
-        tickets = SupportTicket.select().where(
+        # Тикеты вместе с последними сообщениями — без запроса на каждый тикет
+        tickets = SupportTicket.with_last_messages(SupportTicket.select().where(
             SupportTicket.user == user
-        ).order_by(SupportTicket.created_at.desc()).limit(10)
+        ).order_by(SupportTicket.created_at.desc()).limit(10))
 
-        if not tickets.count():
+        if not tickets:
             await callback.message.edit_text(
                 SUPPORT_NO_TICKETS_TEXT,
                 reply_markup=get_support_keyboard()
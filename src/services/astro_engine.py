@@ -2102,6 +2102,33 @@ def get_moon_phase_info(dt: datetime = None) -> Dict:
     }
 
 
+_MINUTES_PER_DAY = 24 * 60
+
+
+def _moon_sun_elongation(jd: float) -> float:
+    """Элонгация Луны от Солнца (0..360°) на юлианскую дату"""
+    sun_lon = swe.calc_ut(jd, swe.SUN)[0][0]
+    moon_lon = swe.calc_ut(jd, swe.MOON)[0][0]
+    return (moon_lon - sun_lon) % 360
+
+
+def _best_minute_of_day(jd_day: float, distance) -> float:
+    """
+    Минута суток (от jd_day) с минимальным distance(элонгация).
+    Внутри суток расстояние до фазы унимодально, поэтому достаточно найти лучший час,
+    а затем перебрать минуты ±1 час вокруг него — результат тот же, что у перебора
+    всех 1440 минут, но ~145 расчётов положения вместо 1440.
+    """
+    def dist(minute: int) -> float:
+        return distance(_moon_sun_elongation(jd_day + minute / _MINUTES_PER_DAY))
+
+    best_hour = min(range(0, _MINUTES_PER_DAY, 60), key=dist)
+    lo = max(0, best_hour - 60)
+    hi = min(_MINUTES_PER_DAY - 1, best_hour + 60)
+    best_minute = min(range(lo, hi + 1), key=dist)
+    return jd_day + best_minute / _MINUTES_PER_DAY
+
+
 def find_exact_new_moon(from_date: datetime) -> datetime:
     """
     Точный поиск новолуния (elongation = 0°) с точностью до минуты.
@@ -2112,7 +2139,6 @@ def find_exact_new_moon(from_date: datetime) -> datetime:
     jd_start = datetime_to_julian(dt_utc, 0)
 
     best_jd = None
-    best_diff = 360.0
 
     # Ищем в диапазоне 35 дней
     for day in range(35):
@@ -2125,20 +2151,8 @@ def find_exact_new_moon(from_date: datetime) -> datetime:
 
         # Если elongation близка к 0° или 360° - уточняем по минутам
         if elongation < 15 or elongation > 345:
-            for minute in range(24 * 60):
-                jd = jd_day + minute / (24 * 60)
-
-                sun_lon = swe.calc_ut(jd, swe.SUN)[0][0]
-                moon_lon = swe.calc_ut(jd, swe.MOON)[0][0]
-                elongation = (moon_lon - sun_lon) % 360
-
-                # Расстояние от 0° (с учётом цикличности 360°)
-                diff = min(elongation, 360 - elongation)
-
-                if diff < best_diff:
-                    best_diff = diff
-                    best_jd = jd
-
+            # Расстояние от 0° (с учётом цикличности 360°)
+            best_jd = _best_minute_of_day(jd_day, lambda e: min(e, 360 - e))
             break  # Нашли день, выходим
 
     if best_jd is None:
@@ -2158,7 +2172,6 @@ def find_exact_full_moon(from_date: datetime) -> datetime:
     jd_start = datetime_to_julian(dt_utc, 0)
 
     best_jd = None
-    best_diff = 360.0
 
     # Ищем в диапазоне 35 дней
     for day in range(35):
@@ -2171,20 +2184,8 @@ def find_exact_full_moon(from_date: datetime) -> datetime:
 
         # Если elongation близка к 180° - уточняем по минутам
         if 165 < elongation < 195:
-            for minute in range(24 * 60):
-                jd = jd_day + minute / (24 * 60)
-
-                sun_lon = swe.calc_ut(jd, swe.SUN)[0][0]
-                moon_lon = swe.calc_ut(jd, swe.MOON)[0][0]
-                elongation = (moon_lon - sun_lon) % 360
-
-                # Расстояние от 180°
-                diff = abs(elongation - 180.0)
-
-                if diff < best_diff:
-                    best_diff = diff
-                    best_jd = jd
-
+            # Расстояние от 180°
+            best_jd = _best_minute_of_day(jd_day, lambda e: abs(e - 180.0))
             break  # Нашли день, выходим
 
     if best_jd is None:
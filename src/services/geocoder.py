@@ -9,8 +9,11 @@
 import logging
 import ssl
 import certifi
+from datetime import datetime, date, time
+from functools import lru_cache
 from typing import Optional, Tuple
 from dataclasses import dataclass
+from zoneinfo import ZoneInfo
 
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut, GeocoderServiceError
@@ -29,7 +32,8 @@ geolocator = Nominatim(
     ssl_context=ssl_context,
     timeout=15
 )
-tf = TimezoneFinder()
+# in_memory=True: данные полигонов целиком в памяти — быстрее timezone_at()
+tf = TimezoneFinder(in_memory=True)
 
 
 @dataclass
@@ -102,6 +106,20 @@ def geocode_city(city_name: str, country: str = None) -> Optional[GeoLocation]:
         return None
 
 
+@lru_cache(maxsize=512)
+def get_zoneinfo(timezone_name: str) -> ZoneInfo:
+    """
+    Объект часового пояса по имени (кэшируется).
+
+    Args:
+        timezone_name: Название часового пояса (например, "Europe/Moscow")
+
+    Returns:
+        ZoneInfo
+    """
+    return ZoneInfo(timezone_name)
+
+
 def get_timezone_offset(timezone_name: str, target_date: 'date' = None) -> float:
     """
     Получить смещение часового пояса в часах для конкретной даты.
@@ -116,24 +134,31 @@ def get_timezone_offset(timezone_name: str, target_date: 'date' = None) -> float
     Returns:
         Смещение в часах от UTC
     """
-    try:
-        import pytz
-        from datetime import datetime, date, time
+    if target_date is None:
+        # Текущий момент не кэшируем
+        try:
+            return datetime.now(get_zoneinfo(timezone_name)).utcoffset().total_seconds() / 3600
+        except Exception as e:
+            logger.error(f"Ошибка определения смещения для {timezone_name}: {e}")
+            return 3.0  # MSK по умолчанию
 
-        tz = pytz.timezone(timezone_name)
+    return _get_timezone_offset_cached(timezone_name, target_date)
 
-        if target_date is None:
-            # Используем текущую дату
-            dt = datetime.now(tz)
+
+@lru_cache(maxsize=4096)
+def _get_timezone_offset_cached(timezone_name: str, target_date) -> float:
+    """Смещение для конкретной даты/datetime — результат не меняется, кэшируем по (tz, дата)"""
+    try:
+        tz = get_zoneinfo(timezone_name)
+
+        # Создаём datetime для указанной даты (полдень для избежания DST переходов)
+        if isinstance(target_date, date) and not isinstance(target_date, datetime):
+            dt = datetime.combine(target_date, time(12, 0, 0))
         else:
-            # Создаём datetime для указанной даты (полдень для избежания DST переходов)
-            if isinstance(target_date, date) and not isinstance(target_date, datetime):
-                dt = datetime.combine(target_date, time(12, 0, 0))
-            else:
-                dt = target_date
-
-            # Локализуем в указанном часовом поясе
-            dt = tz.localize(dt)
+            dt = target_date
+
+        # Локальное время в указанном часовом поясе
+        dt = dt.replace(tzinfo=tz)
 
         offset_seconds = dt.utcoffset().total_seconds()
         return offset_seconds / 3600
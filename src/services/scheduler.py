@@ -360,11 +360,15 @@ async def check_important_transits(app):
 
 def run_async(coro):
     """Обёртка для запуска async функции из синхронного контекста BackgroundScheduler"""
+    from database.models import db
+
     try:
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         try:
-            return loop.run_until_complete(coro)
+            # Задачи идут в потоках планировщика — соединение берём из пула на время задачи
+            with db.connection_context():
+                return loop.run_until_complete(coro)
         finally:
             loop.close()
     except Exception as e: